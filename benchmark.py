@@ -0,0 +1,354 @@
+# Offline benchmark for the moderation pipeline.
+# Drives on_message -> checkMessageWithGemini -> moderateMessage with fake messages and a
+# local Gemini stand-in, so it needs no network, Discord token or API key.
+#
+#   python benchmark.py                      # Free + Tier 1, every moderation mode
+#   python benchmark.py --tiers "Tier 1" --modes Hybrid --messages 500 --error-rate 0.05
+#   python benchmark.py --json bench.json    # also save the results for comparing runs
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import random
+import os
+import re
+import tempfile
+import time
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+# Everything the bot would write to disk goes here instead, so benchmark runs never show up in the
+# real tos.log, audit.jsonl, checkpoints.json or verdict cache. Set before main is imported, which is when its logs open
+scratchDir = tempfile.TemporaryDirectory()
+os.environ["TOS_LOG_DIR"] = scratchDir.name
+
+import main
+
+# Synthetic chat: plain chatter, trivial acks (pre-filter), repeats (cache) and violations
+CLEAN_MESSAGES = [
+    "anyone up for ranked later tonight",
+    "i think the patch nerfed the sniper way too hard",
+    "brb grabbing food, save my spot",
+    "did you see the trailer for the new season",
+    "that boss fight took me like 40 tries",
+    "my internet keeps dropping every few minutes",
+]
+TRIVIAL_MESSAGES = ["lol", "gg", "ok", "thanks", "😂😂", "https://tenor.com/view/cat-dance.gif", "123"]
+PARTIAL_MESSAGES = [
+    "good game everyone but BADWORD you guys",
+    "here is my BADWORD take on the new map",
+]
+FULL_MESSAGES = ["FULLVIOLATION FULLVIOLATION FULLVIOLATION"]
+
+MODES = ["Hybrid", "Edit Only", "Delete Only"]
+TIERS = ["Free", "Tier 1"]
+
+def buildWorkload(count, seed):
+    rng = random.Random(seed)
+    workload = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.3:
+            workload.append(rng.choice(TRIVIAL_MESSAGES))
+        elif roll < 0.45:
+            workload.append(rng.choice(PARTIAL_MESSAGES))
+        elif roll < 0.5:
+            workload.append(rng.choice(FULL_MESSAGES))
+        elif roll < 0.7:
+            # Exact repeats of earlier chatter
+            workload.append(rng.choice(CLEAN_MESSAGES))
+        else:
+            workload.append(f"{rng.choice(CLEAN_MESSAGES)} ({i})")
+    return workload
+
+def fakeVerdict(message):
+    if "FULLVIOLATION" in message:
+        return {"violates_tos": True, "action": "delete", "severity": "full", "violations": [{"phrase": message, "reason": "Benchmark", "replacement": None}]}
+    if "BADWORD" in message:
+        return {"violates_tos": True, "action": "edit", "severity": "partial", "rewritten_message": message.replace("BADWORD", "nice"), "violations": [{"phrase": "BADWORD", "reason": "Benchmark", "replacement": "nice"}]}
+    return {"violates_tos": False, "action": None, "violations": []}
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    def __init__(self, text, chunkDelay):
+        self.text = text
+        self.chunkDelay = chunkDelay
+        self.prompt_feedback = None
+        self.candidates = []
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        # Roughly how Gemini streams: a handful of chunks spread over the reply
+        size = max(1, len(self.text) // 4)
+        for start in range(0, len(self.text), size):
+            yield FakeChunk(self.text[start:start + size])
+            await asyncio.sleep(self.chunkDelay)
+
+class FakeGemini:
+    # Local stand-in for the Gemini API shared by every fake key
+    def __init__(self, latency, errorRate, badRate, quotaRpm, speedup, seed):
+        self.latency = latency / speedup
+        self.errorRate = errorRate
+        self.badRate = badRate
+        self.quotaRpm = quotaRpm * speedup if quotaRpm else 0
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+        self.throttled = 0
+        self.recent = {}  # key -> deque of request times for the 429 window
+
+    def checkQuota(self, apiKey):
+        if not self.quotaRpm:
+            return
+        now = time.monotonic()
+        window = self.recent.setdefault(apiKey, deque())
+        while window and now - window[0] > 60:
+            window.popleft()
+        if len(window) >= self.quotaRpm:
+            self.throttled += 1
+            raise api_exceptions.ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        window.append(now)
+
+    async def generate(self, apiKey, prompt, stream):
+        self.calls += 1
+        self.checkQuota(apiKey)
+
+        # Log-normal-ish latency with a long tail
+        await asyncio.sleep(self.latency * self.rng.lognormvariate(0, 0.5))
+        if self.rng.random() < self.errorRate:
+            self.errors += 1
+            raise api_exceptions.InternalServerError("500 An internal error has occurred.")
+
+        batch = re.search(r'one string per message\):\n(\[.*\])\n', prompt, re.DOTALL)
+        if batch:
+            text = json.dumps([fakeVerdict(m) for m in json.loads(batch.group(1))])
+        else:
+            message = re.search(r'Message to analyze:\n"(.*)"\n', prompt, re.DOTALL).group(1)
+            text = json.dumps(fakeVerdict(message))
+        if self.rng.random() < self.badRate:
+            # Cut off mid-object, like a reply that hit the output limit
+            self.malformed += 1
+            text = text[:len(text) // 2]
+        return FakeResponse(text, self.latency / 10 if stream else 0)
+
+class FakeModel:
+    def __init__(self, server, apiKey):
+        self.server = server
+        self.apiKey = apiKey
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        return await self.server.generate(self.apiKey, prompt, stream)
+
+class FakeAuthor:
+    def __init__(self, id):
+        self.id = id
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+        self.messages = []
+
+    async def history(self, limit=None, after=None, oldest_first=None):
+        for message in self.messages:
+            if message.id > after.id:
+                yield message
+
+class FakeMessage:
+    nextId = 1
+
+    def __init__(self, content, author, started, timings, channel):
+        self.id = FakeMessage.nextId
+        FakeMessage.nextId += 1
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.started = started
+        self.timings = timings
+        self.done = asyncio.Event()
+
+    async def delete(self):
+        self.timings.append(time.monotonic() - self.started)
+
+    async def edit(self, content=None):
+        self.content = content
+        self.timings.append(time.monotonic() - self.started)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+originalProcessMessage = main.processMessage
+
+async def timedProcessMessage(message, receivedAt):
+    # on_message only queues the message, this tells the benchmark when the queue is done with it
+    try:
+        await originalProcessMessage(message, receivedAt)
+    finally:
+        message.done.set()
+
+def resetPipeline(server, tier, mode, args):
+    main.settings = dataclasses.replace(
+        main.settings,
+        apiTier=tier,
+        moderationMode=mode,
+        customPromptInstruction="",
+        isModerationActive=True,
+        contextCaching=False,
+        batchMessages=args.batch,
+        batchWindowMs=args.batch_window / args.speedup,
+        streamResponses=not args.no_stream,
+        maxConcurrentRequests=args.concurrency,
+        hedgeRequests=args.hedge,
+        hedgeBudget=args.hedge_budget,
+    )
+    main.analysisSemaphore = None
+    main.hedger = main.Hedger()
+    main.prefilterSaved = 0
+    main.verdictCache = main.VerdictCache(main.settings.verdictCacheSize, main.settings.verdictCacheTTL)
+    main.nearDuplicates = main.NearDuplicateIndex()
+    main.messageBatcher = main.MessageBatcher()
+    main.analysisQueue = main.AnalysisQueue()
+    main.checkpoints = main.ChannelCheckpoints(os.path.join(scratchDir.name, "checkpoints.json"))
+    main.processMessage = timedProcessMessage
+
+    # Same quotas and backoff, just compressed in time
+    main.BACKOFF_BASE = BASE_BACKOFF[0] / args.speedup
+    main.BACKOFF_CAP = BASE_BACKOFF[1] / args.speedup
+    main.RETRY_DEADLINE = BASE_BACKOFF[2] / args.speedup
+    main.TIER_LIMITS = {name: {"rpm": limits["rpm"] * args.speedup, "tpm": limits["tpm"] * args.speedup} for name, limits in BASE_TIER_LIMITS.items()}
+    main.buildModel = lambda apiKey, systemInstruction=None: FakeModel(server, apiKey)
+    main.apiKeys = [f"bench-key-{i}" for i in range(args.keys)]
+    main.keyPool = main.KeyPool(main.apiKeys)
+
+async def runScenario(tier, mode, workload, args):
+    server = FakeGemini(args.latency, args.error_rate, args.bad_rate, args.quota_rpm, args.speedup, args.seed)
+    resetPipeline(server, tier, mode, args)
+
+    hedgesBefore = main.metrics["hedges"].total(result="sent")
+    me = FakeAuthor(1)
+    main.client._connection.user = me
+    rng = random.Random(args.seed)
+    timings = []
+    tasks = []
+    channel = FakeChannel(1)
+
+    # Messages sent while the bot was down, found by the catch-up scan while live ones keep arriving
+    backlog = [FakeMessage(content, me, time.monotonic(), [], channel) for content in buildWorkload(args.backlog, args.seed + 1)]
+    channel.messages = backlog
+    backlogTime = 0.0
+    if backlog:
+        async def fakeChannel(channelId):
+            return channel
+        main.resolveChannel = fakeChannel
+        main.checkpoints.saved[channel.id] = 0
+
+        async def drainBacklog():
+            nonlocal backlogTime
+            drainStarted = time.monotonic()
+            await main.catchUpChannel(channel.id, 0)
+            await asyncio.gather(*[message.done.wait() for message in backlog])
+            backlogTime = (time.monotonic() - drainStarted) * args.speedup
+        tasks.append(asyncio.ensure_future(drainBacklog()))
+
+    async def handle(content):
+        started = time.monotonic()
+        actions = []
+        message = FakeMessage(content, me, started, actions, channel)
+        await main.on_message(message)
+        await message.done.wait()
+        # Clean messages are "done" once the verdict is in
+        timings.append((actions[0] if actions else time.monotonic() - started) * args.speedup)
+
+    started = time.monotonic()
+    for content in workload:
+        tasks.append(asyncio.ensure_future(handle(content)))
+        # Poisson arrivals at the requested message rate
+        await asyncio.sleep(rng.expovariate(args.rate * args.speedup))
+    await asyncio.gather(*tasks)
+    elapsed = (time.monotonic() - started) * args.speedup
+
+    return {
+        "tier": tier,
+        "mode": mode,
+        "messages": len(workload),
+        "throughput": len(workload) / elapsed,
+        "p50": percentile(timings, 50) * 1000,
+        "p95": percentile(timings, 95) * 1000,
+        "p99": percentile(timings, 99) * 1000,
+        "callsPerMessage": server.calls / len(workload),
+        "prefiltered": main.prefilterSaved,
+        "cacheHits": main.verdictCache.hits,
+        "errors": server.errors,
+        "malformed": server.malformed,
+        "throttled": server.throttled,
+        "hedges": main.metrics["hedges"].total(result="sent") - hedgesBefore,
+        "backlogSeconds": backlogTime,
+    }
+
+def printResults(results):
+    header = f"{'Tier':<7} {'Mode':<12} {'msg/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'calls/msg':>9} {'prefilt':>7} {'cached':>6} {'errors':>6} {'bad':>4} {'429s':>5} {'hedges':>6} {'backlog s':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['tier']:<7} {r['mode']:<12} {r['throughput']:>7.2f} {r['p50']:>8.0f} {r['p95']:>8.0f} {r['p99']:>8.0f} "
+            f"{r['callsPerMessage']:>9.2f} {r['prefiltered']:>7} {r['cacheHits']:>6} {r['errors']:>6} {r['malformed']:>4} {r['throttled']:>5} {r['hedges']:>6} {r['backlogSeconds']:>9.1f}"
+        )
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the ToS moderation pipeline")
+    parser.add_argument("--messages", type=int, default=200, help="messages per scenario")
+    parser.add_argument("--rate", type=float, default=2.0, help="message arrival rate (msgs/s)")
+    parser.add_argument("--keys", type=int, default=2, help="number of fake API keys")
+    parser.add_argument("--latency", type=float, default=0.6, help="median fake Gemini latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail with a 500")
+    parser.add_argument("--bad-rate", type=float, default=0.0, help="fraction of replies that come back as malformed JSON")
+    parser.add_argument("--quota-rpm", type=int, default=0, help="per-key RPM after which the fake server returns 429 (0 = never)")
+    parser.add_argument("--concurrency", type=int, default=4, help="maxConcurrentRequests")
+    parser.add_argument("--batch", action="store_true", help="enable micro-batching")
+    parser.add_argument("--batch-window", type=float, default=400, help="batchWindowMs")
+    parser.add_argument("--hedge", action="store_true", help="enable hedged requests")
+    parser.add_argument("--hedge-budget", type=float, default=0.05, help="hedgeBudget")
+    parser.add_argument("--backlog", type=int, default=0, help="messages missed while offline, drained by the catch-up scan alongside live traffic")
+    parser.add_argument("--no-stream", action="store_true", help="disable streamed responses")
+    parser.add_argument("--speedup", type=float, default=10.0, help="compress quotas and latency by this factor, results are reported in real-world time")
+    parser.add_argument("--tiers", nargs="+", default=TIERS, choices=TIERS)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    return parser.parse_args()
+
+BASE_TIER_LIMITS = dict(main.TIER_LIMITS)
+BASE_BACKOFF = (main.BACKOFF_BASE, main.BACKOFF_CAP, main.RETRY_DEADLINE)
+
+def runBenchmark():
+    args = parseArgs()
+    if not args.verbose:
+        main.log.setLevel(logging.CRITICAL)
+    workload = buildWorkload(args.messages, args.seed)
+    # The bot imports the Gemini SDK during login, do it up front here so it isn't timed
+    main.loadGenai()
+
+    results = []
+    for tier in args.tiers:
+        for mode in args.modes:
+            results.append(asyncio.run(runScenario(tier, mode, workload, args)))
+    printResults(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    runBenchmark()
@@ -1,93 +1,588 @@
+import time
+processStarted = time.monotonic()  # Startup is measured from here
+
 import discord
-import google.generativeai as genai
 import os
 import sys
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import csv
+import argparse
 import re
 import traceback
 import threading
 import asyncio
-import time
 import subprocess
-from PIL import Image, ImageDraw
-from datetime import datetime
+import hashlib
+import random
+import dataclasses
+import functools
+import contextlib
+import contextvars
+import bisect
+import sqlite3
+import zlib
+import unicodedata
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-# Conditional import for pystray to support headless environments
-try:
-    import pystray
-except Exception:
-    pystray = None
+# Heavy or optional dependencies are imported on first use, see loadGenai(), loadTray() and loadOnnx()
+genai = glm = api_exceptions = None
+pystray = Image = ImageDraw = None
+numpy = onnxruntime = tokenizers = None
+importLock = threading.Lock()
+
+def loadGenai():
+    # google-generativeai pulls in grpc and protobuf, the bulk of our import time
+    global genai, glm, api_exceptions
+    if api_exceptions is not None:
+        return
+    with importLock:
+        if api_exceptions is None:
+            import google.generativeai as genaiModule
+            import google.ai.generativelanguage as glmModule
+            from google.api_core import exceptions as exceptionsModule
+            genai, glm, api_exceptions = genaiModule, glmModule, exceptionsModule
+
+def loadTray():
+    # Only the tray needs a GUI stack, headless runs never import it
+    global pystray, Image, ImageDraw
+    try:
+        import pystray as pystrayModule
+        from PIL import Image as imageModule, ImageDraw as imageDrawModule
+    except Exception as e:
+        log.warning(f"Tray unavailable: {e}")
+        return False
+    pystray, Image, ImageDraw = pystrayModule, imageModule, imageDrawModule
+    return True
+
+def loadOnnx():
+    # Optional: only needed for the "local" classifier backend
+    global numpy, onnxruntime, tokenizers
+    if onnxruntime is not None:
+        return True
+    with importLock:
+        try:
+            import numpy as numpyModule
+            import onnxruntime as onnxModule
+            import tokenizers as tokenizersModule
+        except ImportError:
+            return False
+        numpy, onnxruntime, tokenizers = numpyModule, onnxModule, tokenizersModule
+    return True
 
 load_dotenv()
 
 # Configuration State
-isModerationActive = True
-enforcementLevel = "Standard"
-apiTier = "Free"  # "Free" or "Tier 1"
-moderationMode = "Hybrid"  # "Hybrid", "Edit Only", "Delete Only"
-customReplacement = "I follow Discord ToS"
-customPromptInstruction = "" # Custom instruction for Gemini replacements
+# One immutable snapshot, swapped as a whole by updateSettings()/load_config(). The tray thread
+# and the bot's event loop both read it, so never mutate it in place.
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    isModerationActive: bool = True
+    enforcementLevel: str = "Standard"
+    apiTier: str = "Free"  # "Free" or "Tier 1"
+    moderationMode: str = "Hybrid"  # "Hybrid", "Edit Only", "Delete Only"
+    customReplacement: str = "I follow Discord ToS"
+    customPromptInstruction: str = "" # Custom instruction for Gemini replacements
+    maxConcurrentRequests: int = 4  # Cap on in-flight Gemini requests
+    verdictCacheSize: int = 5000  # Max verdicts kept in memory
+    verdictCacheTTL: int = 7 * 24 * 3600  # Seconds before a cached verdict expires
+    persistVerdictCache: bool = True  # Keep verdicts in verdict_cache.db across restarts
+    localPrefilter: bool = True  # Settle trivially clean messages without calling Gemini
+    batchMessages: bool = False  # Group messages sent in quick succession into one Gemini request
+    batchWindowMs: int = 400  # How long a burst is collected before it is sent
+    batchMaxSize: int = 8  # Max messages per batched request
+    contextCaching: bool = True  # Register the policy text as Gemini cached content where supported
+    streamResponses: bool = True  # Act on the verdict while the rest of the response is still streaming
+    metricsPort: int = 9464  # Local Prometheus endpoint (http://127.0.0.1:<port>/metrics), 0 to disable
+    analysisQueueSize: int = 100  # Messages waiting for analysis before on_message applies backpressure
+    classifierBackends: tuple = ("gemini",)  # Tried in order until one gives a verdict: "gemini", "local", "rules"
+    localModelPath: str = "local_model"  # Folder with model.onnx and tokenizer.json for the "local" backend
+    localCleanBelow: float = 0.1  # Local score under which a message is clean without asking Gemini
+    localFlagAbove: float = 0.9  # Local score over which a message is flagged without asking Gemini
+    hedgeRequests: bool = False  # Send a slow Gemini request again on another key, first answer wins
+    hedgePercentile: int = 95  # "Slow" means slower than this percentile of recent requests
+    hedgeBudget: float = 0.05  # Max extra requests hedging may add, as a fraction of all requests
+    segmentLongMessages: bool = True  # Check long messages as several segments in parallel
+    segmentChars: int = 1000  # Messages longer than this are split into segments of about this size
+    nearDuplicateReuse: bool = True  # Reuse the clean verdict of a recent, almost identical message
+    nearDuplicateThreshold: float = 0.85  # How similar (0-1, shared 3-letter chunks) a message must be to reuse a verdict
+    nearDuplicateSize: int = 2000  # Recent clean messages kept for comparison
+    nearDuplicateAudit: float = 0.05  # Fraction of would-be reuses checked for real anyway, to measure false reuse
+    catchUpScan: bool = True  # On login, reconnect or re-enable, check messages sent while the bot wasn't watching
+    catchUpMaxAge: int = 86400  # Never look further back than this many seconds
+    catchUpChannels: int = 3  # Channels scanned at the same time
+    loopStallMs: int = 250  # Log where the event loop was stuck whenever it's blocked for longer than this
+    profileSampling: bool = False  # Sample every thread's stack and write profile.folded for flame graphs
+
+# Lower bounds for numeric settings
+SETTING_MINIMUMS = {
+    "maxConcurrentRequests": 1,
+    "verdictCacheSize": 0,
+    "verdictCacheTTL": 0,
+    "batchWindowMs": 0,
+    "batchMaxSize": 1,
+    "analysisQueueSize": 1,
+    "hedgePercentile": 50,
+    "segmentChars": 200,
+    "nearDuplicateSize": 0,
+    "catchUpMaxAge": 0,
+    "catchUpChannels": 1,
+    "loopStallMs": 50,
+}
+
+settings = Settings()
 
 # API State
 apiKeys = []
-currentKeyIndex = 0
-lastRequestTime = 0
+keyPool = None
+verdictCache = None
+prefilterSaved = 0
+compiledPolicy = None  # (settings, system instruction), rebuilt when a setting changes
+usageStats = {"requests": 0, "promptTokens": 0, "cachedTokens": 0, "latency": 0.0, "firstToken": 0.0}
+analysisSemaphore = None  # Created lazily on the bot's event loop
 
 # Runtime State
+metricsServer = None
 botThread = None
 trayIcon = None
 processingTask = None
 
 CONFIG_FILE = 'config.json'
+CHECKPOINT_FILE = 'checkpoints.json'
+
+CONFIG_SAVE_DELAY = 0.5  # Seconds to wait for more changes before writing config.json
+CONFIG_POLL_INTERVAL = 2.0  # Seconds between checks for external edits to config.json
+
+configLock = threading.Lock()
+saveTimer = None
+configMtime = None  # mtime of the config.json we last read or wrote
+
+def coerceSetting(field, value):
+    # Raises ValueError for values of the wrong type, hand edits shouldn't be guessed at
+    if isinstance(field.default, bool):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+        raise ValueError("expected true or false")
+    if isinstance(field.default, (int, float)):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("expected a number")
+        if isinstance(field.default, float):
+            return float(value)
+        value = int(float(value)) if isinstance(value, str) else int(value)
+        return max(SETTING_MINIMUMS.get(field.name, value), value)
+    if isinstance(field.default, tuple):
+        return tuple(str(item) for item in value) if isinstance(value, (list, tuple)) else (str(value),)
+    return str(value)
+
+def settingsFromDict(config):
+    # Settings that can't be read keep their current value
+    values = {}
+    for field in dataclasses.fields(Settings):
+        current = getattr(settings, field.name)
+        value = config.get(field.name, current)
+        try:
+            values[field.name] = coerceSetting(field, value)
+        except (TypeError, ValueError) as e:
+            log.error(f"Ignoring {field.name} in config.json: {value!r} ({e})")
+            values[field.name] = current
+    return Settings(**values)
+
+def updateSettings(**changes):
+    global settings
+    with configLock:
+        settings = dataclasses.replace(settings, **changes)
+    save_config()
 
 def save_config():
-    config = {
-        "isModerationActive": isModerationActive,
-        "enforcementLevel": enforcementLevel,
-        "apiTier": apiTier,
-        "moderationMode": moderationMode,
-        "customReplacement": customReplacement,
-        "customPromptInstruction": customPromptInstruction,
-        "currentKeyIndex": currentKeyIndex
-    }
+    # Debounced and written from a timer thread, so neither the tray nor the event loop blocks on disk
+    global saveTimer
+    with configLock:
+        if saveTimer is not None:
+            saveTimer.cancel()
+        saveTimer = threading.Timer(CONFIG_SAVE_DELAY, writeConfig)
+        saveTimer.daemon = True
+        saveTimer.start()
+
+def flushConfig():
+    # Write any pending change now, used before exiting
+    global saveTimer
+    with configLock:
+        pending = saveTimer
+        saveTimer = None
+    if pending is not None:
+        pending.cancel()
+        writeConfig()
+
+def writeConfig():
+    global configMtime
+    tmpFile = CONFIG_FILE + '.tmp'
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        with configLock:
+            with open(tmpFile, 'w') as f:
+                json.dump(dataclasses.asdict(settings), f, indent=4)
+            # Atomic swap, a crash mid-write can't leave a half written config.json
+            os.replace(tmpFile, CONFIG_FILE)
+            configMtime = os.stat(CONFIG_FILE).st_mtime_ns
     except Exception as e:
         log.error(f"Failed to save config: {e}")
 
 def load_config():
-    global isModerationActive, enforcementLevel, apiTier, moderationMode, customReplacement, customPromptInstruction, currentKeyIndex
+    global settings, configMtime
     if not os.path.exists(CONFIG_FILE):
         return
 
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-            
-        isModerationActive = config.get("isModerationActive", True)
-        enforcementLevel = config.get("enforcementLevel", "Standard")
-        apiTier = config.get("apiTier", "Free")
-        moderationMode = config.get("moderationMode", "Hybrid")
-        customReplacement = config.get("customReplacement", "I follow Discord ToS")
-        customPromptInstruction = config.get("customPromptInstruction", "")
-        currentKeyIndex = config.get("currentKeyIndex", 0)
+        with configLock:
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+            configMtime = os.stat(CONFIG_FILE).st_mtime_ns
+            settings = settingsFromDict(config)
         
         log.info("Config loaded successfully")
     except Exception as e:
         log.error(f"Failed to load config: {e}")
 
+def watchConfig():
+    # Hot reload: pick up hand edits to config.json without restarting
+    while True:
+        time.sleep(CONFIG_POLL_INTERVAL)
+        try:
+            # rules.txt is hand edited too, checked here so the event loop never stats it
+            classifierBackends["rules"].loadRules()
+        except Exception as e:
+            log.error(f"Failed to reload rules: {e}")
+        try:
+            mtime = os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            continue
+        if mtime == configMtime:
+            continue
+
+        previous = settings
+        load_config()
+        if settings != previous:
+            verdictCache.maxSize = settings.verdictCacheSize
+            verdictCache.ttl = settings.verdictCacheTTL
+            log.info("config.json changed on disk, settings reloaded")
+            if settings.isModerationActive and not previous.isModerationActive:
+                scheduleCatchUp("re-enabled")
+
 jsonRegex = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+jsonArrayRegex = re.compile(r'```(?:json)?\s*(\[.*\])\s*```', re.DOTALL)
+
+LOG_DIR = os.getenv('TOS_LOG_DIR', '')  # where tos.log and audit.jsonl go, benchmark.py points it at a scratch dir
+LOG_FILE = os.path.join(LOG_DIR, 'tos.log')
+LOG_MAX_BYTES = 5 * 1024 * 1024  # tos.log rolls over at this size
+LOG_BACKUPS = 3  # tos.log.1 .. tos.log.3 are kept
+AUDIT_FILE = os.path.join(LOG_DIR, 'audit.jsonl')
+AUDIT_BACKUPS = 14  # audit.jsonl rolls over at midnight, this many days are kept
 
 # Setup logging but keep it simple
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('tos.log'), logging.StreamHandler()]
-)
+# Loggers only drop records on a queue, a background thread does the formatting and disk writes
+# so the event loop never waits on the file system
+logFormatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+notAudit = lambda record: record.name != 'audit'
+
+# delay: files are only created on the first write
+fileHandler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True)
+fileHandler.setFormatter(logFormatter)
+fileHandler.addFilter(notAudit)
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(logFormatter)
+consoleHandler.addFilter(notAudit)
+auditHandler = logging.handlers.TimedRotatingFileHandler(AUDIT_FILE, when='midnight', backupCount=AUDIT_BACKUPS, encoding='utf-8', delay=True)
+auditHandler.addFilter(lambda record: record.name == 'audit')
+
+logQueue = queue.SimpleQueue()
+logListener = logging.handlers.QueueListener(logQueue, fileHandler, consoleHandler, auditHandler)
+logListener.start()
+atexit.register(logListener.stop)
+
+queueHandler = logging.handlers.QueueHandler(logQueue)
+queueHandler.setFormatter(logging.Formatter('%(message)s'))  # the listener's handlers add timestamps
+logging.basicConfig(level=logging.INFO, handlers=[queueHandler])
 log = logging.getLogger(__name__)
+audit = logging.getLogger('audit')  # one JSON line per moderation decision
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        return sum(v for k, v in list(self.values.items()) if set(labels.items()) <= set(k))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in list(self.values.items()):
+            lines.append(f"{self.name}{formatLabels(key)} {value}")
+        return lines
+
+class Gauge:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def mean(self):
+        entries = list(self.values.values())
+        count = sum(e[-1] for e in entries)
+        return sum(e[-2] for e in entries) / count if count else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, entry in list(self.values.items()):
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{self.name}_bucket{formatLabels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{formatLabels(key + (('le', '+Inf'),))} {entry[-1]}")
+            lines.append(f"{self.name}_sum{formatLabels(key)} {entry[-2]}")
+            lines.append(f"{self.name}_count{formatLabels(key)} {entry[-1]}")
+        return lines
+
+# Only updated from the bot's event loop. The tray thread reads them too (metricsSummary), so reads iterate over a copy
+metrics = {
+    "messages": Counter("tos_messages_total", "Messages seen by on_message"),
+    "prefilter": Counter("tos_prefilter_total", "Local pre-filter results"),
+    "cache": Counter("tos_verdict_cache_total", "Verdict cache lookups"),
+    "apiLatency": Histogram("tos_gemini_request_seconds", "Gemini request latency per API key"),
+    "apiErrors": Counter("tos_gemini_errors_total", "Failed Gemini requests per API key and error kind"),
+    "breakerOpens": Counter("tos_gemini_breaker_opens_total", "Times an API key's circuit breaker opened"),
+    "rateLimitWait": Histogram("tos_rate_limit_wait_seconds", "Time spent waiting for key capacity"),
+    "promptTokens": Counter("tos_prompt_tokens_total", "Input tokens sent to Gemini"),
+    "cachedTokens": Counter("tos_cached_tokens_total", "Input tokens served from Gemini cached content"),
+    "parseFailures": Counter("tos_json_parse_failures_total", "Gemini responses that weren't valid JSON"),
+    "safetyBlocks": Counter("tos_safety_blocks_total", "Requests blocked by Gemini's safety filter"),
+    "timeToVerdict": Histogram("tos_time_to_verdict_seconds", "Time from message receipt to verdict"),
+    "timeToAction": Histogram("tos_time_to_action_seconds", "Time from message receipt to edit/delete"),
+    "moderation": Counter("tos_moderation_actions_total", "moderateMessage outcomes"),
+    "queueDepth": Gauge("tos_analysis_queue_depth", "Messages waiting in the analysis queue"),
+    "catchUp": Counter("tos_catch_up_total", "Catch-up scans: channels scanned and missed messages found"),
+    "cancelled": Counter("tos_analysis_cancelled_total", "Analyses dropped because the message was edited or deleted"),
+    "nearDuplicate": Counter("tos_near_duplicate_total", "Near-duplicate lookups: hit, miss, audited (checked anyway) and false_reuse"),
+    "startup": Gauge("tos_startup_seconds", "Seconds from process start to the first on_ready"),
+    "hedges": Counter("tos_gemini_hedged_requests_total", "Duplicate requests sent to another key because the first was slow"),
+    "stages": Histogram("tos_stage_seconds", "Time per message spent in each stage: queue, preprocess, rate_limit, api, parse, moderate"),
+    "loopLag": Histogram("tos_event_loop_lag_seconds", "How late the event loop runs a timer, high values mean something blocked it", LAG_BUCKETS),
+    "loopStalls": Counter("tos_event_loop_stalls_total", "Times the event loop was blocked for longer than loopStallMs"),
+}
+
+def renderMetrics():
+    lines = []
+    for metric in metrics.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STARTUP_BUDGET = 1.0  # Seconds main.py may take to import before main() runs, checked by --startup-check
+startupRecorded = False
+
+def recordStartup():
+    # Once per process, reconnects fire on_ready again
+    global startupRecorded
+    if startupRecorded:
+        return
+    startupRecorded = True
+    elapsed = time.monotonic() - processStarted
+    metrics["startup"].set(round(elapsed, 3))
+    log.info(f"Ready {elapsed:.2f}s after start")
+
+# Per-message trace: stage -> seconds, set by processMessage and filled in by whatever runs on its behalf.
+# Tasks started from there (hedges, segments) inherit it, so their time lands on the same message
+currentTrace = contextvars.ContextVar("currentTrace", default=None)
+
+def recordSpan(stage, seconds):
+    metrics["stages"].observe(seconds, stage=stage)
+    trace = currentTrace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+@contextlib.contextmanager
+def span(stage):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        recordSpan(stage, time.monotonic() - started)
+
+LOOP_TICK = 0.05  # Seconds between event loop heartbeats
+PROFILE_INTERVAL = 0.01  # Seconds between stack samples while profiling
+PROFILE_FILE = 'profile.folded'
+STALL_STACK_DEPTH = 12  # Innermost frames logged for a stall, the asyncio plumbing above them is always the same
+PROFILE_DUMP_INTERVAL = 30.0  # Seconds between profile.folded rewrites
+
+class LoopMonitor:
+    # A heartbeat task on the event loop plus a thread that watches it. When the heartbeat is late the thread
+    # grabs the loop's stack, which shows what's blocking it while it's still blocked.
+    # The same thread does the opt-in sampling profiler, as folded stacks for flamegraph.pl or speedscope
+    def __init__(self):
+        self.loopThread = None
+        self.heartbeat = time.monotonic()
+        self.stallStack = None
+        self.samples = {}  # folded stack -> count
+        self.lastDump = time.monotonic()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loopThread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        asyncio.ensure_future(self.tick())
+        self.thread = threading.Thread(target=self.watch, name="loop-monitor", daemon=True)
+        self.thread.start()
+
+    async def tick(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(LOOP_TICK)
+            now = time.monotonic()
+            self.heartbeat = now
+            lag = max(0.0, now - before - LOOP_TICK)
+            metrics["loopLag"].observe(lag)
+            stack, self.stallStack = self.stallStack, None
+            if lag * 1000 >= settings.loopStallMs:
+                metrics["loopStalls"].inc()
+                log.warning(f"Event loop was blocked for {lag * 1000:.0f}ms" + (f", stuck in:\n{stack}" if stack else ""))
+
+    def watch(self):
+        while True:
+            time.sleep(PROFILE_INTERVAL if settings.profileSampling else min(settings.loopStallMs / 2000, 0.1))
+            try:
+                frames = sys._current_frames()
+                frame = frames.get(self.loopThread)
+                if self.stallStack is None and frame is not None and time.monotonic() - self.heartbeat >= settings.loopStallMs / 1000 + LOOP_TICK:
+                    self.stallStack = "".join(traceback.format_stack(frame, limit=STALL_STACK_DEPTH)).rstrip()
+                if settings.profileSampling:
+                    self.sample(frames)
+                elif self.samples:
+                    self.dumpProfile()
+                    self.samples = {}
+            except Exception as e:
+                log.error(f"Loop monitor failed: {e}")
+
+    def sample(self, frames):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in frames.items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            # Folded format: root first, ';' between frames, then the count
+            key = ";".join([names.get(ident, str(ident)).replace(" ", "_")] + stack[::-1])
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+        if time.monotonic() - self.lastDump >= PROFILE_DUMP_INTERVAL:
+            self.dumpProfile()
+
+    def dumpProfile(self):
+        # Counts since profiling was turned on, rewritten in place so the file is always complete
+        self.lastDump = time.monotonic()
+        if not self.samples:
+            return
+        tmpFile = PROFILE_FILE + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+            os.replace(tmpFile, PROFILE_FILE)
+        except Exception as e:
+            log.error(f"Failed to write {PROFILE_FILE}: {e}")
+
+loopMonitor = LoopMonitor()
+
+def metricsSummary():
+    checked = metrics["messages"].total()
+    callCount = sum(e[-1] for e in list(metrics["apiLatency"].values.values()))
+    lookups = metrics["cache"].total()
+    prefiltered = metrics["prefilter"].total(result="skipped")
+    cacheRate = metrics["cache"].total(result="hit") / lookups * 100 if lookups else 0.0
+    prefilterRate = prefiltered / checked * 100 if checked else 0.0
+    return (
+        f"Checked {checked}, Gemini calls {callCount} (avg {metrics['apiLatency'].mean() * 1000:.0f}ms)\n"
+        f"Pre-filter {prefilterRate:.0f}%, cache hits {cacheRate:.0f}%, near-duplicates {metrics['nearDuplicate'].total(result='hit')} "
+        f"({metrics['nearDuplicate'].total(result='false_reuse')}/{metrics['nearDuplicate'].total(result='audited')} audited were wrong)\n"
+        f"Deleted {metrics['moderation'].total(outcome='deleted')}, edited {metrics['moderation'].total(outcome='edited')}, "
+        f"failed {metrics['moderation'].total(outcome='not_found') + metrics['moderation'].total(outcome='forbidden') + metrics['moderation'].total(outcome='error')}"
+    )
+
+async def handleMetricsRequest(reader, writer):
+    try:
+        requestLine = await reader.readline()
+        # Skip the headers, we don't need any of them
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = requestLine.split()
+        if len(parts) >= 2 and parts[1] == b"/metrics":
+            status, body = "200 OK", renderMetrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        log.error(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def startMetricsServer():
+    global metricsServer
+    if metricsServer is not None or not settings.metricsPort:
+        return
+    try:
+        metricsServer = await asyncio.start_server(handleMetricsRequest, "127.0.0.1", settings.metricsPort)
+        log.info(f"Metrics available at http://127.0.0.1:{settings.metricsPort}/metrics")
+    except Exception as e:
+        log.error(f"Failed to start metrics endpoint: {e}")
 
 # Load API Keys
 env_keys = os.getenv('GEMINI_API_KEYS')
@@ -101,26 +596,8 @@ else:
 if not apiKeys:
     log.error("No API keys found! Set GEMINI_API_KEYS (comma separated) or GEMINI_API_KEY in .env")
 
-# Load config before configuring GenAI so we use the saved key index
 load_config()
 
-# Ensure key index is valid
-if apiKeys and currentKeyIndex >= len(apiKeys):
-    currentKeyIndex = 0
-    save_config()
-
-def configure_genai():
-    global currentKeyIndex
-    if not apiKeys:
-        return
-    try:
-        genai.configure(api_key=apiKeys[currentKeyIndex])
-        log.info(f"Switched to API Key index: {currentKeyIndex}")
-    except Exception as e:
-        log.error(f"Failed to configure API key: {e}")
-
-configure_genai()
-
 # Configure safety settings to allow the model to analyze toxic content without blocking
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
@@ -128,7 +605,747 @@ safety_settings = [
     {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
 ]
-model = genai.GenerativeModel('gemini-2.5-flash-lite', safety_settings=safety_settings)
+
+MODEL_NAME = 'gemini-2.5-flash-lite'
+
+# Per-key quotas for gemini-2.5-flash-lite. Each key has its own quota, so N keys = N times these.
+TIER_LIMITS = {
+    "Free": {"rpm": 20, "tpm": 250000},
+    "Tier 1": {"rpm": 4000, "tpm": 4000000},
+}
+
+CONTEXT_CACHE_TTL = 3600  # Seconds a registered policy cache lives on Gemini's side
+CONTEXT_CACHE_GRACE = 120  # Seconds a replaced cache is kept for requests still using it, then deleted
+
+def buildModel(apiKey, systemInstruction=None):
+    # Each key gets its own client so several keys can be used at the same time
+    loadGenai()
+    keyModel = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings, system_instruction=systemInstruction)
+    keyModel._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": apiKey})
+    return keyModel
+
+class TokenBucket:
+    def __init__(self, perMinute):
+        self.capacity = float(perMinute)
+        self.rate = perMinute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def waitTime(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+BACKOFF_BASE = 1.0  # Seconds, first retry/cooldown before jitter
+BACKOFF_CAP = 60.0  # Longest retry/cooldown we pick ourselves, server-suggested delays can be longer
+BREAKER_THRESHOLD = 3  # Consecutive server errors before a key's breaker opens
+BREAKER_AUTH_OPEN = 600.0  # Seconds a key with an auth error is left alone
+RETRY_DEADLINE = 20.0  # Give up on a message if no key will be usable for this long
+
+class KeysUnavailable(Exception):
+    pass
+
+retryDelayRegex = re.compile(r'retry(?:_delay|Delay)?\W+(?:in\s+|seconds:\s*)?"?(\d+(?:\.\d+)?)\s*s?', re.IGNORECASE)
+
+def classifyError(e):
+    # quota: this key is out of quota. auth: this key is bad. server: transient on Gemini's side.
+    # network: we can't reach Gemini at all, not the key's fault. request: the request itself is wrong, retrying won't help.
+    if isinstance(e, KeysUnavailable):
+        return "unavailable"
+    loadGenai()
+    if isinstance(e, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)):
+        return "quota"
+    if isinstance(e, (api_exceptions.Unauthenticated, api_exceptions.PermissionDenied, api_exceptions.Forbidden)):
+        return "auth"
+    if isinstance(e, (api_exceptions.InvalidArgument, api_exceptions.BadRequest)):
+        # A bad key also comes back as a 400
+        return "auth" if "api key" in str(e).lower() else "request"
+    if isinstance(e, (ConnectionError, asyncio.TimeoutError, OSError)):
+        return "network"
+    if isinstance(e, api_exceptions.ServiceUnavailable) and "connect" in str(e).lower():
+        return "network"
+    return "server"
+
+def retryAfterSeconds(e):
+    # Server-suggested delay: google.rpc.RetryInfo in the error details, or the "retry in 37s" text
+    for detail in getattr(e, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            return float(str(detail["retryDelay"]).rstrip("s"))
+    response = getattr(e, "response", None)
+    header = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if header and header.isdigit():
+        return float(header)
+    match = retryDelayRegex.search(str(e))
+    return float(match.group(1)) if match else None
+
+def backoffDelay(attempt):
+    # Full jitter, so keys and messages that failed together don't retry together
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+class CircuitBreaker:
+    # closed: requests flow. open: the key is skipped until reopenAt. half_open: one probe request decides.
+    def __init__(self, index):
+        self.index = index
+        self.state = "closed"
+        self.failures = 0  # consecutive
+        self.opens = 0  # consecutive, grows the open time
+        self.reopenAt = 0.0
+        self.probing = False
+
+    def waitTime(self):
+        if self.state == "open":
+            wait = self.reopenAt - time.monotonic()
+            if wait > 0:
+                return wait
+            self.state = "half_open"
+            log.info(f"API key index {self.index} half-open, sending a probe request")
+        if self.state == "half_open" and self.probing:
+            return 1.0
+        return 0.0
+
+    def onAcquire(self):
+        if self.state == "half_open":
+            self.probing = True
+
+    def onSuccess(self):
+        if self.state != "closed":
+            log.info(f"API key index {self.index} recovered")
+        self.state = "closed"
+        self.failures = 0
+        self.opens = 0
+        self.probing = False
+
+    def onNeutral(self):
+        # Cancelled, or failed for reasons that say nothing about this key
+        self.probing = False
+
+    def onFailure(self, kind, retryAfter):
+        self.failures += 1
+        self.probing = False
+        if kind == "server" and self.state == "closed" and self.failures < BREAKER_THRESHOLD:
+            return
+
+        if kind == "auth":
+            duration = BREAKER_AUTH_OPEN
+        else:
+            duration = max(retryAfter or 0.0, backoffDelay(self.opens) + BACKOFF_BASE)
+        self.opens += 1
+        self.state = "open"
+        self.reopenAt = time.monotonic() + duration
+        metrics["breakerOpens"].inc(key=self.index, kind=kind)
+        log.warning(f"API key index {self.index} breaker open for {duration:.0f}s ({kind})")
+
+class ApiKeySlot:
+    def __init__(self, index, key):
+        self.index = index
+        self.key = key
+        self.model = None
+        self.modelPolicy = None
+        self.modelLock = None
+        self.cacheClient = None
+        self.cacheName = None
+        self.cacheExpires = 0.0
+        self.tier = None
+        self.requestBucket = None
+        self.tokenBucket = None
+        self.breaker = CircuitBreaker(index)
+        self.inFlight = 0
+
+    def applyTier(self, tier):
+        limits = TIER_LIMITS.get(tier, TIER_LIMITS["Free"])
+        self.tier = tier
+        self.requestBucket = TokenBucket(limits["rpm"])
+        self.tokenBucket = TokenBucket(limits["tpm"])
+
+    def isModelCurrent(self, policyKey):
+        if self.model is None or self.modelPolicy != policyKey:
+            return False
+        return self.cacheName is None or time.monotonic() < self.cacheExpires
+
+    async def getModel(self):
+        policyKey, policyText = getCompiledPolicy()
+        if self.isModelCurrent(policyKey):
+            return self.model
+
+        if self.modelLock is None:
+            self.modelLock = asyncio.Lock()
+        async with self.modelLock:
+            if self.isModelCurrent(policyKey):
+                return self.model
+            # Same policy, the cache is just about to expire: keep it alive instead of registering a new one
+            if self.model is not None and self.modelPolicy == policyKey and self.cacheName and settings.contextCaching:
+                if await self.extendCache():
+                    return self.model
+
+            oldCache, self.cacheName = self.cacheName, None
+            keyModel = await self.buildCachedModel(policyText) if settings.contextCaching else None
+            if keyModel is None:
+                keyModel = buildModel(self.key, policyText)
+            self.model = keyModel
+            self.modelPolicy = policyKey
+            if oldCache:
+                asyncio.ensure_future(self.retireCache(oldCache))
+        return self.model
+
+    async def extendCache(self):
+        try:
+            from google.protobuf import field_mask_pb2
+            await self.cacheClient.update_cached_content(
+                cached_content=genai.protos.CachedContent(name=self.cacheName, ttl=timedelta(seconds=CONTEXT_CACHE_TTL)),
+                update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+            )
+        except Exception as e:
+            log.warning(f"Couldn't extend cached content {self.cacheName} for key index {self.index}, registering it again: {e}")
+            return False
+        self.cacheExpires = time.monotonic() + CONTEXT_CACHE_TTL - 120
+        log.info(f"Extended cached content for key index {self.index}: {self.cacheName}")
+        return True
+
+    async def retireCache(self, name):
+        # Requests already sent with the old model may still be using it, give them time to finish
+        await asyncio.sleep(CONTEXT_CACHE_GRACE)
+        try:
+            await self.cacheClient.delete_cached_content(name=name)
+            log.info(f"Deleted superseded cached content for key index {self.index}: {name}")
+        except Exception as e:
+            log.warning(f"Couldn't delete cached content {name}, it will expire on its own: {e}")
+
+    async def buildCachedModel(self, policyText):
+        try:
+            loadGenai()
+            if self.cacheClient is None:
+                self.cacheClient = glm.CacheServiceAsyncClient(client_options={"api_key": self.key})
+            cache = await self.cacheClient.create_cached_content(genai.protos.CreateCachedContentRequest(
+                cached_content=genai.protos.CachedContent(
+                    model=f"models/{MODEL_NAME}",
+                    system_instruction=genai.protos.Content(parts=[genai.protos.Part(text=policyText)]),
+                    ttl=timedelta(seconds=CONTEXT_CACHE_TTL),
+                )
+            ))
+        except Exception as e:
+            # e.g. the policy is below the model's minimum cacheable size
+            log.warning(f"Context caching unavailable for key index {self.index}, sending policy as system instruction: {e}")
+            return None
+
+        log.info(f"Registered policy as cached content for key index {self.index}: {cache.name}")
+        self.cacheName = cache.name
+        self.cacheExpires = time.monotonic() + CONTEXT_CACHE_TTL - 120
+        keyModel = buildModel(self.key)
+        keyModel._cached_content = cache.name
+        return keyModel
+
+    def waitTime(self, tokens):
+        cooldown = self.breaker.waitTime()
+        if cooldown > 0:
+            return cooldown
+        return max(self.requestBucket.waitTime(1), self.tokenBucket.waitTime(tokens))
+
+    def take(self, tokens):
+        self.requestBucket.take(1)
+        self.tokenBucket.take(tokens)
+        self.inFlight += 1
+        self.breaker.onAcquire()
+
+class KeyPool:
+    def __init__(self, keys):
+        self.slots = [ApiKeySlot(i, key) for i, key in enumerate(keys)]
+
+    async def acquire(self, tokens, deadline=None):
+        # Pick whichever key can take the request soonest, spreading load across all keys.
+        # Raises KeysUnavailable if every key's breaker stays open past the deadline.
+        started = time.monotonic()
+        while True:
+            for slot in self.slots:
+                if slot.tier != settings.apiTier:
+                    slot.applyTier(settings.apiTier)
+
+            slot = min(self.slots, key=lambda s: (s.waitTime(tokens), s.inFlight))
+            wait_time = slot.waitTime(tokens)
+            if wait_time <= 0:
+                slot.take(tokens)
+                metrics["rateLimitWait"].observe(time.monotonic() - started)
+                recordSpan("rate_limit", time.monotonic() - started)
+                return slot
+
+            if all(s.breaker.state != "closed" for s in self.slots):
+                if deadline is not None and time.monotonic() + wait_time > deadline:
+                    raise KeysUnavailable(f"All API keys unavailable for the next {wait_time:.0f}s")
+                log.info(f"All API keys backing off, waiting {wait_time:.2f}s")
+            else:
+                log.info(f"Rate limit ({settings.apiTier}): Waiting {wait_time:.2f}s for key capacity")
+            await asyncio.sleep(wait_time)
+
+    def tryAcquire(self, tokens, exclude=()):
+        # A healthy key that can take the request right now, or None. Hedging uses this and never queues.
+        ready = [s for s in self.slots if s not in exclude and s.tier == settings.apiTier and s.waitTime(tokens) <= 0]
+        if not ready:
+            return None
+        slot = min(ready, key=lambda s: s.inFlight)
+        slot.take(tokens)
+        return slot
+
+    async def warmUp(self):
+        # Build every key's model (and register the cached policy) now rather than on the first messages
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, loadGenai)
+        for slot in self.slots:
+            try:
+                await slot.getModel()
+            except Exception as e:
+                log.warning(f"Couldn't prepare key index {slot.index} yet: {e}")
+
+    def release(self, slot, ok, error=None):
+        slot.inFlight -= 1
+        if ok is None:
+            # Cancelled by us, says nothing about the key's health
+            slot.breaker.onNeutral()
+            return
+        if ok:
+            slot.breaker.onSuccess()
+            return
+
+        kind = classifyError(error)
+        if kind in ("network", "request"):
+            slot.breaker.onNeutral()
+            return
+        # Stop sending to a key that's clearly out instead of rotating back to it every time
+        slot.breaker.onFailure(kind, retryAfterSeconds(error))
+
+def estimateTokens(text):
+    # ~4 chars per token plus headroom for the JSON reply
+    return len(text) // 4 + 256
+
+if apiKeys:
+    keyPool = KeyPool(apiKeys)
+
+CACHE_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), 'verdict_cache.db')
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), 'rules.txt')
+
+def normalizeMessage(text):
+    # Fold case/width/whitespace so "LOL " and "lol" share a verdict
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split())
+
+# Structured output: requests ask for exactly the "Response format" in BASE_TOS_CONTEXT
+VIOLATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "phrase": {"type": "string"},
+        "reason": {"type": "string"},
+        "replacement": {"type": "string", "nullable": True},
+    },
+    "required": ["phrase", "reason"],
+}
+VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "violates_tos": {"type": "boolean"},
+        "action": {"type": "string", "enum": ["edit", "delete"], "nullable": True},
+        "severity": {"type": "string", "enum": ["partial", "full"], "nullable": True},
+        "rewritten_message": {"type": "string", "nullable": True},
+        "violations": {"type": "array", "items": VIOLATION_SCHEMA},
+    },
+    "required": ["violates_tos", "violations"],
+}
+VERDICT_CONFIG = {"response_mime_type": "application/json", "response_schema": VERDICT_SCHEMA}
+BATCH_CONFIG = {"response_mime_type": "application/json", "response_schema": {"type": "array", "items": VERDICT_SCHEMA}}
+
+class Violation:
+    # start/end are character offsets into the message when we know exactly where the phrase is
+    __slots__ = ("phrase", "reason", "replacement", "start", "end")
+
+    def __init__(self, phrase, reason="", replacement=None, start=None, end=None):
+        self.phrase = phrase
+        self.reason = reason
+        self.replacement = replacement
+        self.start = start
+        self.end = end
+
+    def toDict(self):
+        data = {"phrase": self.phrase, "reason": self.reason, "replacement": self.replacement}
+        if self.start is not None:
+            data["start"], data["end"] = self.start, self.end
+        return data
+
+class Verdict:
+    # A checked model reply. The same object is handed to every message with a cached verdict, so don't modify it
+    __slots__ = ("violates", "action", "severity", "rewritten", "violations")
+
+    def __init__(self, violates=False, action=None, severity=None, rewritten=None, violations=()):
+        self.violates = violates
+        self.action = action
+        self.severity = severity
+        self.rewritten = rewritten
+        self.violations = violations
+
+    @classmethod
+    def fromDict(cls, data):
+        # Raises ValueError for anything moderateMessage couldn't act on
+        if not isinstance(data, dict) or not isinstance(data.get("violates_tos"), bool):
+            raise ValueError("missing or non-boolean violates_tos")
+
+        items = data.get("violations") or []
+        if not isinstance(items, list):
+            raise ValueError("violations is not a list")
+        violations = []
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get("phrase"), str):
+                raise ValueError("violation without a phrase")
+            replacement = item.get("replacement")
+            start, end = item.get("start"), item.get("end")
+            if not (isinstance(start, int) and isinstance(end, int)):
+                start = end = None
+            violations.append(Violation(item["phrase"], str(item.get("reason") or ""), replacement if isinstance(replacement, str) else None, start, end))
+
+        action = data.get("action")
+        severity = data.get("severity")
+        if action not in (None, "edit", "delete") or severity not in (None, "partial", "full"):
+            raise ValueError(f"unknown action/severity: {action}/{severity}")
+        rewritten = data.get("rewritten_message")
+        rewritten = rewritten if isinstance(rewritten, str) and rewritten.strip() else None
+
+        if not data["violates_tos"]:
+            # Rule 12: a clean verdict has nothing to fix. A stray action alone is harmless, stray violations mean
+            # the model contradicted itself and we can't tell which half to believe
+            if violations:
+                raise ValueError("violates_tos is false but violations were listed (rule 12)")
+            return CLEAN_VERDICT
+
+        if action is None:
+            action = "delete" if severity == "full" else "edit"
+        if action == "edit" and not violations and rewritten is None:
+            raise ValueError("edit verdict with nothing to replace")
+        return cls(True, action, severity, rewritten, tuple(violations))
+
+    def toDict(self):
+        data = {"violates_tos": self.violates, "action": self.action, "severity": self.severity, "violations": [v.toDict() for v in self.violations]}
+        if self.rewritten is not None:
+            data["rewritten_message"] = self.rewritten
+        return data
+
+    def __repr__(self):
+        return f"Verdict({self.toDict()})"
+
+CLEAN_VERDICT = Verdict()
+
+def blockedVerdict(reason):
+    return Verdict(True, "delete", "full", None, (Violation("Entire Message", reason),))
+
+def parseVerdict(responseText):
+    # JSON mode replies are bare JSON, the fence strip is for replies that come back without it
+    jsonMatch = jsonRegex.search(responseText)
+    if jsonMatch:
+        responseText = jsonMatch.group(1)
+    return Verdict.fromDict(json.loads(responseText))
+
+class VerdictCache:
+    def __init__(self, maxSize, ttl, dbPath=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (storedAt, Verdict)
+        self.hits = 0
+        self.misses = 0
+        self.dbPath = dbPath
+        self.db = None
+        self.dbLock = threading.Lock()
+
+    def open(self):
+        # Called by the bot and --replay before the event loop starts, so importing main (benchmark.py) never touches
+        # verdict_cache.db. The newest entries are loaded into memory here, lookups never read the disk.
+        if not self.dbPath or self.db is not None:
+            return
+        try:
+            self.db = sqlite3.connect(self.dbPath, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, stored_at REAL, analysis TEXT)")
+            self.db.execute("DELETE FROM verdicts WHERE stored_at < ?", (time.time() - self.ttl,))
+            self.db.commit()
+            rows = self.db.execute("SELECT key, stored_at, analysis FROM verdicts ORDER BY stored_at DESC LIMIT ?", (self.maxSize,)).fetchall()
+        except Exception as e:
+            log.error(f"Failed to open verdict cache db: {e}")
+            self.db = None
+            return
+
+        for key, storedAt, analysis in reversed(rows):
+            try:
+                self.remember(key, (storedAt, Verdict.fromDict(json.loads(analysis))))
+            except ValueError:
+                pass  # Stored by an older version in a shape we no longer accept
+        log.info(f"Loaded {len(self.entries)} cached verdicts")
+
+    def makeKey(self, messageContent):
+        # Everything that can change the model's answer is part of the key
+        parts = [normalizeMessage(messageContent), settings.enforcementLevel, settings.moderationMode, settings.customPromptInstruction, MODEL_NAME]
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None or now - entry[0] > self.ttl:
+            if entry is not None:
+                self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, verdict):
+        if self.maxSize <= 0:
+            return
+        entry = (time.time(), verdict)
+        self.remember(key, entry)
+
+        if self.db is not None:
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self.writeEntry, key, entry)
+            except RuntimeError:
+                self.writeEntry(key, entry)
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def writeEntry(self, key, entry):
+        try:
+            with self.dbLock:
+                self.db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)", (key, entry[0], json.dumps(entry[1].toDict())))
+                self.db.commit()
+        except Exception as e:
+            log.error(f"Verdict cache write failed: {e}")
+
+verdictCache = VerdictCache(settings.verdictCacheSize, settings.verdictCacheTTL, CACHE_DB_FILE if settings.persistVerdictCache else None)
+
+# Near-duplicate reuse: MinHash over 3-character chunks of the normalized text, with LSH banding so a lookup
+# only compares against messages that share at least one band instead of the whole index
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16  # 16 bands of 4 rows: pairs above ~50% similarity become candidates, the threshold does the rest
+MINHASH_PRIME = (1 << 61) - 1
+minhashRng = random.Random(20240601)  # fixed so signatures are comparable across the whole run
+MINHASH_PARAMS = [(minhashRng.randrange(1, MINHASH_PRIME), minhashRng.randrange(MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+NEAR_DUPLICATE_MIN_CHARS = 12  # Shorter messages change too much with one character to compare safely
+NEAR_DUPLICATE_TTL = 3600  # Seconds a clean message stays reusable
+nearDuplicateWordRegex = re.compile(r"\w+")
+
+@functools.lru_cache(maxsize=256)
+def minhashSignature(normalized):
+    # crc32 rather than hash(), which changes between runs, so similarities (and --self-check) are repeatable
+    hashes = {zlib.crc32(normalized[i:i + 3].encode("utf-8")) for i in range(len(normalized) - 2)}
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMS)
+
+def withinOneEdit(a, b):
+    # Levenshtein distance <= 1, i.e. one typo
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    # Rest must match after one substitution (same length) or one insertion into a
+    return a[i + 1:] == b[i + 1:] if len(a) == len(b) else a[i:] == b[i + 1:]
+
+# Words that flip a sentence's meaning, these have to match exactly, never as a typo of something else
+NEGATION_WORDS = frozenset([
+    "no", "not", "never", "nor", "neither", "none", "nothing", "nobody", "nowhere", "without", "dont", "don",
+    "doesnt", "didnt", "isnt", "arent", "wasnt", "werent", "wont", "wouldnt", "cant", "cannot", "couldnt",
+    "shouldnt", "stop",
+])
+TYPO_MIN_LETTERS = 4  # Shorter words are too often a different word one letter away
+
+def hasWord(word, words):
+    if word in words:
+        return True
+    if word in NEGATION_WORDS or len(word) < TYPO_MIN_LETTERS:
+        return False
+    return any(withinOneEdit(word, other) for other in words if other not in NEGATION_WORDS and len(other) >= TYPO_MIN_LETTERS)
+
+def sameWords(words, storedWords):
+    # Similar text can still add an insult or drop a "not", so both messages must use the same words give or take a typo
+    return all(hasWord(word, storedWords) for word in words) and all(hasWord(word, words) for word in storedWords)
+
+# (stored clean message, new message, may reuse), run by --self-check
+NEAR_DUPLICATE_CHECKS = [
+    ("i am not going to kill you tomorrow at your house okay", "i am going to kill you tomorrow at your house okay", False),
+    ("i would never send you a token logger, that stuff is sketchy", "i would send you a token logger, that stuff is sketchy", False),
+    ("don't ddos the server tonight, the admins are watching", "ddos the server tonight, the admins are watching", False),
+    ("hey everyone, anyone want to play some valorant tonight after dinner", "hey everyone, anyone want to play some valorant tonight after dinner, kys BADWORD", False),
+    ("hey everyone, anyone want to play some valorant tonight after dinner", "hey everyone, anyone want to play some valorant tonight after diner", True),
+    ("hey everyone, anyone want to play some valorant tonight after dinner", "hey everyone anyone want to play some valorant tonight after dinner!", True),
+]
+
+def checkNearDuplicates():
+    # Failed (stored, new) pairs. Unsafe pairs must fail the word check on its own, whatever their similarity,
+    # safe ones must be reused by the index at the configured threshold
+    failures = []
+    for stored, new, expected in NEAR_DUPLICATE_CHECKS:
+        if expected:
+            index = NearDuplicateIndex()
+            index.add(stored, CLEAN_VERDICT)
+            ok = index.lookup(new) is not None
+        else:
+            wordsOf = lambda text: frozenset(nearDuplicateWordRegex.findall(normalizeMessage(text)))
+            ok = not sameWords(wordsOf(new), wordsOf(stored))
+        if not ok:
+            failures.append((stored, new))
+    return failures
+
+class NearDuplicateIndex:
+    def __init__(self):
+        self.entries = OrderedDict()  # id -> (signature, words, bandKeys, verdict, storedAt)
+        self.buckets = {}  # (policy, band, rows) -> ids
+        self.nextId = 0
+
+    def bandKeys(self, policyKey, signature):
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        return [(policyKey, band, signature[band * rows:(band + 1) * rows]) for band in range(MINHASH_BANDS)]
+
+    def signatureFor(self, messageContent):
+        # (signature, words), or None for messages too short to compare or too long to hash on the event loop
+        normalized = normalizeMessage(messageContent)
+        if not NEAR_DUPLICATE_MIN_CHARS <= len(normalized) <= settings.segmentChars:
+            return None
+        return minhashSignature(normalized), frozenset(nearDuplicateWordRegex.findall(normalized))
+
+    def lookup(self, messageContent):
+        # (verdict, similarity) of the closest recent clean message under the same policy, or None
+        signed = self.signatureFor(messageContent)
+        if signed is None:
+            return None
+        signature, words = signed
+        policyKey = getCompiledPolicy()[0]
+        candidates = set()
+        for key in self.bandKeys(policyKey, signature):
+            candidates.update(self.buckets.get(key, ()))
+
+        now = time.time()
+        best = None
+        for entryId in candidates:
+            entrySignature, entryWords, _, verdict, storedAt = self.entries[entryId]
+            if now - storedAt > NEAR_DUPLICATE_TTL:
+                continue
+            similarity = sum(x == y for x, y in zip(signature, entrySignature)) / MINHASH_PERMUTATIONS
+            if similarity < settings.nearDuplicateThreshold or (best is not None and similarity <= best[2]):
+                continue
+            if sameWords(words, entryWords):
+                best = (entryId, verdict, similarity)
+        if best is None:
+            return None
+        self.entries.move_to_end(best[0])
+        return best[1], best[2]
+
+    def add(self, messageContent, verdict):
+        signed = self.signatureFor(messageContent)
+        if signed is None or settings.nearDuplicateSize <= 0:
+            return
+        signature, words = signed
+        keys = self.bandKeys(getCompiledPolicy()[0], signature)
+        entryId = self.nextId
+        self.nextId += 1
+        self.entries[entryId] = (signature, words, keys, verdict, time.time())
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(entryId)
+
+        while len(self.entries) > settings.nearDuplicateSize:
+            oldId, (_, _, oldKeys, _, _) = self.entries.popitem(last=False)
+            for key in oldKeys:
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(oldId)
+                    if not bucket:
+                        del self.buckets[key]
+
+nearDuplicates = NearDuplicateIndex()
+
+# Local pre-filter: things that can't break the rules in BASE_TOS_CONTEXT never reach Gemini
+urlRegex = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+discordMarkupRegex = re.compile(r'<a?:\w+:\d+>|<[@#][!&]?\d+>|:\w+:')  # custom emoji, mentions, :shortcodes:
+tokenRegex = re.compile(r"[^\W_]+")  # letters and digits together, so "k1ll" stays one token
+repeatRegex = re.compile(r'(.)\1{2,}')  # runs of 3 or more, collapsed to 2 so "kkk" never becomes "k"
+runRegex = re.compile(r'(.)\1*')
+
+# Short acknowledgements that are safe at every level
+SAFE_ACKS = [
+    "ok", "okay", "lol", "lmao", "haha", "hahaha", "hehe", "xd", "gg", "ggs", "ty", "thx", "thanks",
+    "thank", "you", "np", "yes", "yeah", "yep", "yup", "no", "nope", "nah", "hi", "hello", "hey", "bye", "gn",
+    "gm", "brb", "afk", "idk", "ikr", "nice", "cool", "true", "same", "wait", "what", "why", "how", "hmm", "oh",
+    "ah", "sure", "bet", "sup", "yo", "rip", "omg", "fr", "ong", "welcome", "mb", "sry", "sorry",
+]
+# Only safe when mild profanity is allowed
+LOOSE_ACKS = ["lmfao", "wtf", "ffs", "af"]
+# Emoji that Strict treats as suggestive/profane
+STRICT_EMOJI = "\U0001F595\U0001F346\U0001F351\U0001F4A6"
+PREFILTER_MAX_WORDS = 8
+
+prefilterLexicons = {}
+
+def getPrefilterLexicon(level):
+    lexicon = prefilterLexicons.get(level)
+    if lexicon is None:
+        words = SAFE_ACKS if level == "Strict" else SAFE_ACKS + LOOSE_ACKS
+        # Each word plus one letter doubled, so "okkk" / "yesss" / "lmaooo" (collapsed to "okk", "yess", "lmaoo") still match
+        lexicon = set(words)
+        for word in words:
+            for run in runRegex.finditer(word):
+                if len(run.group(0)) == 1:
+                    lexicon.add(word[:run.start()] + run.group(0) * 2 + word[run.end():])
+        lexicon = frozenset(lexicon)
+        prefilterLexicons[level] = lexicon
+    return lexicon
+
+def isTriviallyClean(messageContent, level):
+    remaining = discordMarkupRegex.sub(" ", urlRegex.sub(" ", messageContent)).casefold()
+    tokens = tokenRegex.findall(remaining)
+    words = [token for token in tokens if not token.isdigit()]
+
+    if level == "Strict" and any(c in STRICT_EMOJI for c in remaining):
+        return False
+    if not words:
+        # Only links, emoji, mentions, numbers or punctuation left
+        return True
+
+    if len(words) > PREFILTER_MAX_WORDS:
+        return False
+    if any(not word.isalpha() for word in words):
+        # Letters mixed with digits can be leetspeak ("k1ll"), let the model read it
+        return False
+
+    lexicon = getPrefilterLexicon(level)
+    return all(repeatRegex.sub(r'\1\1', w) in lexicon for w in words)
+
+# (message, level, settled as clean by the pre-filter), run by --self-check
+PREFILTER_CHECKS = [
+    ("ok \U0001F346", "Strict", False),
+    ("\U0001F346", "Strict", False),
+    ("\U0001F346", "Standard", True),
+    ("gg \U0001F602", "Strict", True),
+    ("kkk", "Strict", False),
+    ("KKK", "Lenient", False),
+    ("k1ll", "Lenient", False),
+    ("k", "Standard", False),
+    ("okkk yesss lmaooo", "Strict", True),
+    ("gg 123", "Strict", True),
+    ("wtf", "Strict", False),
+    ("wtf", "Standard", True),
+]
+
+def checkPrefilter():
+    return [(message, level) for message, level, expected in PREFILTER_CHECKS if isTriviallyClean(message, level) != expected]
 
 client = discord.Client()
 
@@ -158,6 +1375,7 @@ Discord's Terms of Service specifically prohibit the following behaviors (Sectio
 Response format (JSON only):
 {
     "violates_tos": true/false,
+    "action": "edit" or "delete",
     "severity": "partial" or "full",
     "rewritten_message": "safe version of the full message (optional)",
     "violations": [
@@ -166,8 +1384,7 @@ Response format (JSON only):
             "reason": "brief reason linking to specific prohibition above",
             "replacement": "suggested safe replacement" or null
         }
-    ],
-    "action": "edit" or "delete"
+    ]
 }
 
 IMPORTANT GUIDELINES:
@@ -212,154 +1429,873 @@ ENFORCEMENT LEVEL: LENIENT (Minimum ToS Compliance)
 """
     return ""
 
-async def checkMessageWithGemini(messageContent):
-    global currentKeyIndex, lastRequestTime
-    
-    # Rate Limiting Logic
-    now = time.time()
-    if apiTier == "Free":
-        # 20 RPM = 1 request every 3 seconds
-        timeSinceLast = now - lastRequestTime
-        if timeSinceLast < 3.0:
-            wait_time = 3.0 - timeSinceLast
-            log.info(f"Rate limit (Free): Waiting {wait_time:.2f}s")
-            await asyncio.sleep(wait_time)
+def getAnalysisSemaphore():
+    # asyncio primitives have to be created on the bot's loop, not at import time
+    global analysisSemaphore
+    if analysisSemaphore is None:
+        analysisSemaphore = asyncio.Semaphore(settings.maxConcurrentRequests)
+    return analysisSemaphore
+
+def buildPromptHeader(snapshot):
+    levelInstructions = getEnforcementInstructions(snapshot.enforcementLevel)
+
+    # Construct the replacement rule dynamically
+    if snapshot.customPromptInstruction:
+        replacementRule = f"REPLACEMENT RULE: You MUST provide a 'rewritten_message' that rewrites the ENTIRE message to be safe, based on this instruction: {snapshot.customPromptInstruction}"
+    elif snapshot.moderationMode == "Edit Only":
+        replacementRule = "REPLACEMENT RULE: You MUST provide a 'rewritten_message' that rewrites the ENTIRE message to be safe. It MUST be exactly: \"I follow discord tos\"."
     else:
-        # Tier 1: 4000 RPM = ~0.015s per request (negligible, but let's be safe)
-        timeSinceLast = now - lastRequestTime
-        if timeSinceLast < 0.02:
-            await asyncio.sleep(0.02)
-            
-    lastRequestTime = time.time()
+        replacementRule = "REPLACEMENT RULE: For 'partial' violations, the 'replacement' MUST be exactly: \"I follow discord tos\"."
+
+    return f"{BASE_TOS_CONTEXT}\n{replacementRule}\n{levelInstructions}"
+
+def getCompiledPolicy():
+    # The policy only changes when a setting does, so it's built once per combination
+    global compiledPolicy
+    snapshot = settings  # one read, so a tray change mid-build can't mix two configs
+    policyKey = (snapshot.enforcementLevel, snapshot.moderationMode, snapshot.customPromptInstruction)
+    if compiledPolicy is None or compiledPolicy[0] != policyKey:
+        compiledPolicy = (policyKey, buildPromptHeader(snapshot))
+    return compiledPolicy
+
+def recordUsage(response, elapsed, firstToken):
+    usage = getattr(response, "usage_metadata", None)
+    usageStats["requests"] += 1
+    usageStats["latency"] += elapsed
+    usageStats["firstToken"] += firstToken
+    if usage:
+        usageStats["promptTokens"] += usage.prompt_token_count
+        usageStats["cachedTokens"] += usage.cached_content_token_count
+        metrics["promptTokens"].inc(usage.prompt_token_count)
+        metrics["cachedTokens"].inc(usage.cached_content_token_count)
 
+    count = usageStats["requests"]
+    if count == 1 or count % 20 == 0:
+        log.info(
+            f"Gemini usage: {count} requests, avg {usageStats['promptTokens'] / count:.0f} input tokens "
+            f"({usageStats['cachedTokens'] / count:.0f} cached), avg first token {usageStats['firstToken'] / count * 1000:.0f}ms, "
+            f"avg latency {usageStats['latency'] / count * 1000:.0f}ms"
+        )
+
+streamVerdictRegex = re.compile(r'"violates_tos"\s*:\s*(true|false)')
+streamActionRegex = re.compile(r'"action"\s*:\s*"(edit|delete)"')
+streamSeverityRegex = re.compile(r'"severity"\s*:\s*"(partial|full)"')
+CLEAN_VERDICT_TEXT = '{"violates_tos": false}'
+
+def peekStreamVerdict(text):
+    # Looks at a partial response: "clean", "delete", or None if it's too early to tell
+    verdict = streamVerdictRegex.search(text)
+    if not verdict:
+        return None
+    if verdict.group(1) == "false":
+        return "clean"
+    if settings.moderationMode == "Delete Only":
+        return "delete"
+    if settings.moderationMode == "Edit Only":
+        return None
+
+    action = streamActionRegex.search(text)
+    if action:
+        return action.group(1)
+    severity = streamSeverityRegex.search(text)
+    if severity and severity.group(1) == "full":
+        return "delete"
+    return None
+
+async def closeStream(response):
+    # Best effort: stop pulling the rest of the response off the wire
+    aclose = getattr(getattr(response, "_iterator", None), "aclose", None)
+    if aclose:
+        try:
+            await aclose()
+        except Exception:
+            pass
+
+async def streamResponse(keyModel, prompt, generationConfig, started, onEarlyDelete):
+    # Returns (response, text, time to first chunk); text is None if nothing usable was streamed
+    response = await keyModel.generate_content_async(prompt, stream=True, generation_config=generationConfig)
+    firstToken = time.monotonic() - started
+    text = ""
     try:
-        levelInstructions = getEnforcementInstructions(enforcementLevel)
-        
-        # Construct the replacement rule dynamically
-        if customPromptInstruction:
-            replacementRule = f"REPLACEMENT RULE: You MUST provide a 'rewritten_message' that rewrites the ENTIRE message to be safe, based on this instruction: {customPromptInstruction}"
-        elif moderationMode == "Edit Only":
-            replacementRule = "REPLACEMENT RULE: You MUST provide a 'rewritten_message' that rewrites the ENTIRE message to be safe. It MUST be exactly: \"I follow discord tos\"."
+        # The peek reads one verdict's fields, a batch reply is an array of them and has to be read in full
+        peek = generationConfig is VERDICT_CONFIG
+        async for chunk in response:
+            text += chunk.text
+            if not peek:
+                continue
+            verdict = peekStreamVerdict(text)
+            if verdict == "clean":
+                # Nothing to act on, don't wait for the rest
+                await closeStream(response)
+                return response, CLEAN_VERDICT_TEXT, firstToken
+            if verdict == "delete" and onEarlyDelete:
+                onEarlyDelete()
+    except (ValueError, genai.types.BlockedPromptException, genai.types.StopCandidateException):
+        # Blocked mid-stream, the caller inspects the accumulated response
+        return response, None, firstToken
+    return response, text.strip(), firstToken
+
+HEDGE_SAMPLES = 200  # Recent requests the hedge threshold and budget are worked out over
+HEDGE_MIN_SAMPLES = 20  # No hedging until we know what "slow" looks like
+
+class Hedger:
+    def __init__(self):
+        self.latencies = deque(maxlen=HEDGE_SAMPLES)
+        self.recent = deque(maxlen=HEDGE_SAMPLES)  # 1 for each recent request that was hedged, else 0
+        self.hedged = 0
+
+    def observe(self, elapsed):
+        self.latencies.append(elapsed)
+
+    def delay(self):
+        # How long to wait before hedging, None while it's off or there isn't enough history
+        if not settings.hedgeRequests or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * settings.hedgePercentile / 100))]
+
+    def allow(self):
+        return self.hedged + 1 <= settings.hedgeBudget * max(len(self.recent), HEDGE_MIN_SAMPLES)
+
+    def record(self, hedged):
+        if len(self.recent) == self.recent.maxlen:
+            self.hedged -= self.recent[0]
+        self.recent.append(int(hedged))
+        self.hedged += int(hedged)
+
+hedger = Hedger()
+
+async def callKey(slot, prompt, onEarlyDelete, generationConfig):
+    # One request on an acquired key: the response text or a safety Verdict. Raises on errors, always releases the key.
+    semaphore = getAnalysisSemaphore()
+    ok = False
+    error = None
+    try:
+        keyModel = await slot.getModel()
+        # Async call so the gateway heartbeat and other events keep running
+        async with semaphore:
+            started = time.monotonic()
+            if settings.streamResponses:
+                response, responseText, firstToken = await streamResponse(keyModel, prompt, generationConfig, started, onEarlyDelete)
+            else:
+                response = await keyModel.generate_content_async(prompt, generation_config=generationConfig)
+                responseText = None
+                firstToken = time.monotonic() - started
+            elapsed = time.monotonic() - started
+            recordUsage(response, elapsed, firstToken)
+            recordSpan("api", elapsed)
+            metrics["apiLatency"].observe(elapsed, key=slot.index)
+            hedger.observe(elapsed)
+        ok = True
+        try:
+            if responseText:
+                return responseText
+            return response.text.strip()
+        except ValueError:
+            # Handle blocked responses
+            if response.prompt_feedback and response.prompt_feedback.block_reason:
+                log.warning(f"Gemini blocked the prompt: {response.prompt_feedback.block_reason}")
+                metrics["safetyBlocks"].inc(kind="prompt")
+                # If the prompt is blocked, it's likely a severe violation
+                return blockedVerdict("Triggered AI Safety Filter (Prompt Blocked)")
+
+            if response.candidates and response.candidates[0].finish_reason != 1: # 1 is STOP
+                 log.warning(f"Gemini blocked the response. Finish reason: {response.candidates[0].finish_reason}")
+                 metrics["safetyBlocks"].inc(kind="response")
+                 return blockedVerdict("Triggered AI Safety Filter (Response Blocked)")
+
+            # If we get here, it's a weird empty response
+            log.error("Gemini returned an empty response without a clear block reason.")
+            raise ValueError("Empty response from Gemini")
+    except asyncio.CancelledError:
+        ok = None
+        raise
+    except Exception as e:
+        ok = False
+        error = e
+        metrics["apiErrors"].inc(key=slot.index, kind=classifyError(e))
+        log.error(f"API Error with key index {slot.index} ({classifyError(e)}): {e}")
+        raise
+    finally:
+        keyPool.release(slot, ok, error)
+
+async def hedgedCall(slot, tokens, prompt, onEarlyDelete, generationConfig):
+    # If the request is slow, send it again on another key and take whichever answers first
+    tasks = [asyncio.ensure_future(callKey(slot, prompt, onEarlyDelete, generationConfig))]
+    hedged = False
+    try:
+        delay = hedger.delay()
+        if delay is None:
+            return await tasks[0]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not hedger.allow():
+            return await tasks[0]
+        backupSlot = keyPool.tryAcquire(tokens, exclude=(slot,))
+        if backupSlot is None:
+            return await tasks[0]
+
+        hedged = True
+        metrics["hedges"].inc(result="sent")
+        log.info(f"Key index {slot.index} slower than {delay * 1000:.0f}ms, hedging on key index {backupSlot.index}")
+        tasks.append(asyncio.ensure_future(callKey(backupSlot, prompt, onEarlyDelete, generationConfig)))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is tasks[1]:
+                        metrics["hedges"].inc(result="won")
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        hedger.record(hedged)
+        # The loser is cancelled, its key is released without a penalty
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+async def generateWithKeys(prompt, onEarlyDelete=None, generationConfig=VERDICT_CONFIG):
+    # Returns the response text, or a ready-made Verdict if the safety filter blocked it
+
+    # Retry logic for multiple keys. Quota and auth errors open that key's breaker, so the next
+    # attempt goes straight to another key. Server and network errors back off first.
+    max_retries = len(apiKeys) + 2
+    deadline = time.monotonic() + RETRY_DEADLINE
+    tokens = estimateTokens(prompt) + len(getCompiledPolicy()[1]) // 4
+    for attempt in range(max_retries):
+        slot = await keyPool.acquire(tokens, deadline)
+        try:
+            return await hedgedCall(slot, tokens, prompt, onEarlyDelete, generationConfig)
+        except Exception as e:
+            kind = classifyError(e)
+            if kind in ("request", "unavailable") or attempt == max_retries - 1:
+                # If it's a safety block that we caught above, we returned already.
+                # If it's a real API error (network, etc), we raise it here.
+                raise e # All keys failed
+            if kind in ("server", "network"):
+                delay = min(backoffDelay(attempt), max(0.0, deadline - time.monotonic()))
+                log.info(f"Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+            else:
+                log.info("Retrying with next key...")
+
+PARSE_ATTEMPTS = 2  # Times a message is asked about before an unusable reply is given up on
+
+async def analyzeMessage(messageContent, onEarlyDelete=None):
+    # One message, one request. Returns None if no usable verdict came back.
+    # The policy itself goes out as the system instruction / cached content
+    basePrompt = f"Message to analyze:\n\"{messageContent}\"\n\nProvide your analysis in JSON format."
+    prompt = basePrompt
+    for attempt in range(PARSE_ATTEMPTS):
+        try:
+            result = await generateWithKeys(prompt, onEarlyDelete)
+        except Exception as e:
+            log.error(f"Gemini API error (All keys failed): {e}")
+            return None
+        if isinstance(result, Verdict):
+            return result
+
+        try:
+            with span("parse"):
+                verdict = parseVerdict(result)
+        except ValueError as e:
+            log.error(f"Unusable verdict ({e}) | Text: {result}")
+            metrics["parseFailures"].inc()
+            # Ask again and say what was wrong, rather than letting the message through unchecked
+            prompt = f"{basePrompt}\n\nYour previous reply was rejected: {e}. Reply with only the JSON object in the required format."
+            continue
+
+        log.debug(f"Gemini analysis ({settings.enforcementLevel}): {verdict}")
+        return verdict
+
+    log.error(f"No usable verdict after {PARSE_ATTEMPTS} attempts, leaving message unchecked")
+    return None
+
+async def analyzeBatch(contents):
+    # Several messages share one copy of the policy text and one request
+    verdicts = [None] * len(contents)
+    responseText = ""
+    try:
+        prompt = (
+            f"Messages to analyze (JSON array, one string per message):\n{json.dumps(contents, ensure_ascii=False)}\n\n"
+            f"Provide your analysis as a JSON array containing exactly {len(contents)} analysis objects, one per message, in the same order."
+        )
+        result = await generateWithKeys(prompt, generationConfig=BATCH_CONFIG)
+        if isinstance(result, str):
+            responseText = result
+            jsonMatch = jsonArrayRegex.search(responseText)
+            if jsonMatch:
+                responseText = jsonMatch.group(1)
+
+            analyses = json.loads(responseText)
+            if isinstance(analyses, list) and len(analyses) == len(contents):
+                for i, data in enumerate(analyses):
+                    try:
+                        verdicts[i] = Verdict.fromDict(data)
+                    except ValueError as e:
+                        log.warning(f"Unusable verdict in batch ({e}), re-checking that message on its own")
+                        metrics["parseFailures"].inc()
+                log.debug(f"Gemini batch analysis ({settings.enforcementLevel}, {len(contents)} messages): {verdicts}")
+            else:
+                log.warning(f"Batch response didn't have {len(contents)} verdicts, checking messages individually")
         else:
-            replacementRule = "REPLACEMENT RULE: For 'partial' violations, the 'replacement' MUST be exactly: \"I follow discord tos\"."
-            
-        prompt = f"{BASE_TOS_CONTEXT}\n{replacementRule}\n{levelInstructions}\n\nMessage to analyze:\n\"{messageContent}\"\n\nProvide your analysis in JSON format."
-        
-        # Retry logic for multiple keys
-        max_retries = len(apiKeys)
-        for attempt in range(max_retries):
-            try:
-                response = model.generate_content(prompt)
-                try:
-                    responseText = response.text.strip()
-                except ValueError:
-                    # Handle blocked responses
-                    if response.prompt_feedback and response.prompt_feedback.block_reason:
-                        log.warning(f"Gemini blocked the prompt: {response.prompt_feedback.block_reason}")
-                        # If the prompt is blocked, it's likely a severe violation
-                        return {"violates_tos": True, "severity": "full", "action": "delete", "violations": [{"phrase": "Entire Message", "reason": "Triggered AI Safety Filter (Prompt Blocked)"}]}
-                    
-                    if response.candidates and response.candidates[0].finish_reason != 1: # 1 is STOP
-                         log.warning(f"Gemini blocked the response. Finish reason: {response.candidates[0].finish_reason}")
-                         return {"violates_tos": True, "severity": "full", "action": "delete", "violations": [{"phrase": "Entire Message", "reason": "Triggered AI Safety Filter (Response Blocked)"}]}
-                    
-                    # If we get here, it's a weird empty response
-                    log.error("Gemini returned an empty response without a clear block reason.")
-                    raise ValueError("Empty response from Gemini")
-
-                break # Success
-            except Exception as e:
-                log.error(f"API Error with key index {currentKeyIndex}: {e}")
-                if attempt < max_retries - 1:
-                    currentKeyIndex = (currentKeyIndex + 1) % len(apiKeys)
-                    save_config() # Save new key index
-                    configure_genai()
-                    log.info("Retrying with next key...")
-                    await asyncio.sleep(1)
-                else:
-                    # If it's a safety block that we caught above, we returned already.
-                    # If it's a real API error (network, etc), we raise it here.
-                    raise e # All keys failed
+            # Can't tell which message tripped the filter
+            log.warning("Batch blocked by safety filter, checking messages individually")
 
-        jsonMatch = jsonRegex.search(responseText)
-        if jsonMatch:
-            responseText = jsonMatch.group(1)
-        
-        analysis = json.loads(responseText)
-        log.info(f"Gemini analysis ({enforcementLevel}): {analysis}")
-        return analysis
-        
     except json.JSONDecodeError as e:
-        log.error(f"JSON parse error: {e} | Text: {responseText}")
-        return {"violates_tos": False}
+        log.error(f"Batch JSON parse error: {e} | Text: {responseText}")
+        metrics["parseFailures"].inc()
     except Exception as e:
         log.error(f"Gemini API error (All keys failed): {e}")
-        return {"violates_tos": False}
+        return verdicts
+
+    # Only the messages without a usable verdict are asked about again
+    missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    for i, verdict in zip(missing, await asyncio.gather(*[analyzeMessage(contents[i]) for i in missing])):
+        verdicts[i] = verdict
+    return verdicts
+
+SEGMENT_OVERLAP = 80  # Chars each segment repeats from the end of the previous one
+segmentBoundaryRegex = re.compile(r'(?<=[.!?])\s+|\n+')  # sentence and line ends
+whitespaceRegex = re.compile(r'\s+')
+
+def lastPointIn(points, low, high):
+    # Largest point with low < point <= high, or None
+    i = bisect.bisect_right(points, high)
+    return points[i - 1] if i and points[i - 1] > low else None
+
+def firstPointIn(points, low, high):
+    # Smallest point with low <= point < high, or None
+    i = bisect.bisect_left(points, low)
+    return points[i] if i < len(points) and points[i] < high else None
+
+def splitSegments(text, size, overlap):
+    # (start, end) spans of at most size chars, cut after a sentence or line where possible, else between words.
+    # Each segment after the first backs up to overlap chars into the previous one, so a phrase across the cut is seen whole.
+    boundaries = [m.end() for m in segmentBoundaryRegex.finditer(text)]
+    wordStarts = [m.end() for m in whitespaceRegex.finditer(text)]
+    spans = []
+    start = 0
+    while len(text) - start > size:
+        limit = start + size
+        end = lastPointIn(boundaries, start + size // 2, limit) or lastPointIn(wordStarts, start + size // 2, limit) or limit
+        spans.append((start, end))
+        start = max(firstPointIn(wordStarts, end - overlap, end) or end, start + 1)
+    spans.append((start, len(text)))
+    return spans
 
-async def moderateMessage(message, analysis):
+def mergeSegmentVerdicts(content, spans, verdicts):
+    # One verdict for the whole message, with violations located by offset in the full text
+    flagged = [(span, verdict) for span, verdict in zip(spans, verdicts) if verdict.violates]
+    if not flagged:
+        return CLEAN_VERDICT
+
+    # "Edit Only" asks every segment for the same fixed rewrite, so if every segment was flagged that's the whole
+    # message's rewrite too. Any other rewrite only covers its own segment and must not replace the whole message
+    rewrites = {verdict.rewritten for _, verdict in flagged}
+    fixedRewrite = settings.moderationMode == "Edit Only" and not settings.customPromptInstruction
+    rewritten = rewrites.pop() if fixedRewrite and len(flagged) == len(spans) and len(rewrites) == 1 else None
+
+    # Rewrites are only asked for with a custom prompt or "Edit Only", otherwise the phrases are more precise
+    rewriteRequested = bool(settings.customPromptInstruction) or settings.moderationMode == "Edit Only"
+    usesRewrite = lambda verdict: rewritten is None and verdict.rewritten is not None and (rewriteRequested or not verdict.violations)
+
+    violations = {}
+    for i, ((start, end), verdict) in enumerate(flagged):
+        segment = content[start:end]
+        if usesRewrite(verdict):
+            # The segment's rewrite replaces the segment. Where the next segment is rewritten too, stop at its start
+            # so the overlap isn't replaced twice
+            if i + 1 < len(flagged) and usesRewrite(flagged[i + 1][1]) and flagged[i + 1][0][0] < end:
+                end = flagged[i + 1][0][0]
+            reason = verdict.violations[0].reason if verdict.violations else "Rewritten segment"
+            violations.setdefault((start, end), Violation(content[start:end], reason, verdict.rewritten, start, end))
+            continue
+        if verdict.action == "delete" or not verdict.violations:
+            # The whole segment is the problem
+            reason = verdict.violations[0].reason if verdict.violations else "Entire segment"
+            violations.setdefault((start, end), Violation(segment, reason, None, start, end))
+            continue
+        for violation in verdict.violations:
+            phrase = violation.phrase.strip()
+            phrase = phrase.rstrip('.,!?;:') or phrase
+            match = re.search(phrasePattern(phrase), segment, re.IGNORECASE) if phrase else None
+            if match is None:
+                # Left for replaceViolations to look for in the whole message
+                violations.setdefault(phrase.casefold(), violation)
+                continue
+            phraseStart, phraseEnd = start + match.start(), start + match.end()
+            violations.setdefault((phraseStart, phraseEnd), Violation(content[phraseStart:phraseEnd], violation.reason, violation.replacement, phraseStart, phraseEnd))
+
+    full = len(flagged) == len(spans) and all(verdict.severity == "full" or verdict.action == "delete" for _, verdict in flagged)
+    return Verdict(True, "delete" if full else "edit", "full" if full else "partial", rewritten, tuple(violations.values()))
+
+async def analyzeSegmented(messageContent):
+    # Segments are checked at the same time, so a long message takes about as long as its slowest segment
+    spans = splitSegments(messageContent, settings.segmentChars, SEGMENT_OVERLAP)
+    log.info(f"Long message ({len(messageContent)} chars), checking {len(spans)} segments in parallel")
+    verdicts = await asyncio.gather(*[analyzeMessage(messageContent[start:end]) for start, end in spans])
+    if any(verdict is None for verdict in verdicts):
+        return None
+    return mergeSegmentVerdicts(messageContent, spans, verdicts)
+
+class MessageBatcher:
+    def __init__(self):
+        self.pending = []  # (content, future)
+        self.flushHandle = None
+        self.lastArrival = 0.0
+        self.tasks = set()
+
+    def submit(self, messageContent):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        window = settings.batchWindowMs / 1000
+
+        # A message arriving after a quiet spell goes out immediately, bursts get grouped
+        now = time.monotonic()
+        idle = now - self.lastArrival > window
+        self.lastArrival = now
+
+        self.pending.append((messageContent, future))
+        if len(self.pending) >= settings.batchMaxSize or (idle and len(self.pending) == 1):
+            self.flush()
+        elif self.flushHandle is None:
+            self.flushHandle = loop.call_later(window, self.flush)
+        return future
+
+    def flush(self):
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.runBatch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def runBatch(self, batch):
+        # Shared by several messages, so don't bill it to whichever one started the batch
+        currentTrace.set(None)
+        results = []
+        try:
+            contents = [content for content, _ in batch]
+            if len(contents) == 1:
+                results = [await analyzeMessage(contents[0])]
+            else:
+                results = await analyzeBatch(contents)
+        finally:
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(results[i] if i < len(results) else None)
+
+messageBatcher = MessageBatcher()
+
+# Classifier backends, chained by settings.classifierBackends. classify() returns a Verdict, or None to pass
+# the message on to the next backend. The last backend in the chain is told it's final and should commit to an answer.
+class ClassifierBackend:
+    name = None
+    cacheable = False  # Whether verdicts are worth keeping in the verdict cache
+
+    def available(self):
+        return True
+
+    async def classify(self, messageContent, final, onEarlyDelete=None, decision=None):
+        raise NotImplementedError
+
+class GeminiBackend(ClassifierBackend):
+    name = "gemini"
+    cacheable = True
+
+    def available(self):
+        return keyPool is not None
+
+    async def classify(self, messageContent, final, onEarlyDelete=None, decision=None):
+        # None when every key failed, so a fallback backend can take over
+        if settings.segmentLongMessages and len(messageContent) > settings.segmentChars:
+            decision["source"] = "segmented"
+            return await analyzeSegmented(messageContent)
+        if settings.batchMessages:
+            decision["source"] = "batch"
+            return await messageBatcher.submit(messageContent)
+        decision["source"] = "api"
+        return await analyzeMessage(messageContent, onEarlyDelete)
+
+class RulesBackend(ClassifierBackend):
+    # Regexes from rules.txt (one per line, # for comments), matched case-insensitively
+    name = "rules"
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.rules = []
+        self.loadRules()
+
+    def loadRules(self):
+        # Reloaded by the config watcher thread, never on the event loop
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.mtime, self.rules = None, []
+            return
+        if mtime == self.mtime:
+            return
+
+        rules = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    rules.append(re.compile(line, re.IGNORECASE))
+                except re.error as e:
+                    log.error(f"Bad rule in {self.path}: {line} ({e})")
+        self.mtime, self.rules = mtime, rules
+        log.info(f"Loaded {len(rules)} rules from {self.path}")
+
+    def available(self):
+        return bool(self.rules)
+
+    async def classify(self, messageContent, final, onEarlyDelete=None, decision=None):
+        violations = [
+            Violation(match.group(0), f"Matched local rule: {rule.pattern}")
+            for rule in self.rules for match in rule.finditer(messageContent) if match.group(0).strip()
+        ]
+        if violations:
+            return Verdict(True, "edit", "partial", None, tuple(violations))
+        # No rule matched: only an answer if nothing comes after us
+        return CLEAN_VERDICT if final else None
+
+LOCAL_MAX_TOKENS = 256  # Longer messages are truncated for the local model
+
+class LocalBackend(ClassifierBackend):
+    # A small ONNX text classifier run on the CPU, e.g. a quantized toxicity model exported from Hugging Face.
+    # Scores in between localCleanBelow and localFlagAbove are passed on, unless this is the last backend.
+    name = "local"
+
+    def __init__(self):
+        self.path = None
+        self.session = None
+        self.tokenizer = None
+        self.failed = None  # path we couldn't load, so we don't retry it for every message
+        self.lastScore = (None, 0.0)  # the chain may ask twice (first pass and fallback), score once
+        self.loadLock = threading.Lock()
+        self.importing = False
+
+    def available(self):
+        if settings.localModelPath == self.failed:
+            return False
+        if onnxruntime is None:
+            # Importing onnxruntime takes a while, messages skip this backend until it's done
+            self.prepare()
+            return False
+        return True
+
+    def prepare(self):
+        if self.importing or onnxruntime is not None:
+            return
+        self.importing = True
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self.importOnnx)
+        except RuntimeError:
+            self.importOnnx()  # No event loop (--replay setup), nothing to block
+
+    def importOnnx(self):
+        if not loadOnnx():
+            log.error("The local backend needs onnxruntime, numpy and tokenizers installed")
+            self.failed = settings.localModelPath
+        self.importing = False
+
+    def load(self, path):
+        try:
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = 2  # leave the rest of the CPU to discord.py
+            self.session = onnxruntime.InferenceSession(os.path.join(path, "model.onnx"), options, providers=["CPUExecutionProvider"])
+            self.tokenizer = tokenizers.Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+            self.tokenizer.enable_truncation(max_length=LOCAL_MAX_TOKENS)
+            self.path = path
+            log.info(f"Loaded local classifier from {path}")
+        except Exception as e:
+            self.session = None
+            self.failed = path
+            log.error(f"Failed to load local classifier from {path}: {e}")
+
+    def score(self, messageContent):
+        # Runs in a worker thread, onnxruntime releases the GIL while it computes
+        path = settings.localModelPath
+        with self.loadLock:
+            if self.session is None or self.path != path:
+                self.load(path)
+            session, tokenizer = self.session, self.tokenizer
+        if session is None:
+            return None
+
+        encoding = tokenizer.encode(messageContent)
+        inputs = {
+            "input_ids": encoding.ids,
+            "attention_mask": encoding.attention_mask,
+            "token_type_ids": encoding.type_ids,
+        }
+        feeds = {i.name: numpy.array([inputs[i.name]], dtype=numpy.int64) for i in session.get_inputs() if i.name in inputs}
+        logits = numpy.atleast_1d(session.run(None, feeds)[0][0])
+
+        if len(logits) == 2:
+            # [clean, toxic] softmax
+            exps = numpy.exp(logits - logits.max())
+            return float(exps[1] / exps.sum())
+        # single toxicity logit, or one per toxicity label
+        return float((1 / (1 + numpy.exp(-logits))).max())
+
+    async def classify(self, messageContent, final, onEarlyDelete=None, decision=None):
+        if self.lastScore[0] == messageContent:
+            score = self.lastScore[1]
+        else:
+            score = await asyncio.get_running_loop().run_in_executor(None, self.score, messageContent)
+            if score is None:
+                return None
+            self.lastScore = (messageContent, score)
+
+        if score >= settings.localFlagAbove:
+            # No phrase-level detail, so the whole message is the violation
+            return Verdict(True, "edit", "full", None, (Violation(messageContent, f"Local classifier score {score:.2f}"),))
+        if score < settings.localCleanBelow or final:
+            return CLEAN_VERDICT
+        return None
+
+classifierBackends = {backend.name: backend for backend in (GeminiBackend(), RulesBackend(RULES_FILE), LocalBackend())}
+warnedBackends = set()
+
+def getClassifierChain():
+    chain = []
+    for name in settings.classifierBackends:
+        backend = classifierBackends.get(name)
+        if backend is None:
+            if name not in warnedBackends:
+                warnedBackends.add(name)
+                log.error(f"Unknown classifier backend in config: {name}")
+            continue
+        if backend.available():
+            chain.append(backend)
+    return chain
+
+async def checkMessageWithGemini(messageContent, onEarlyDelete=None, decision=None):
+    # decision (optional) gets told where the verdict came from, for the audit log
+    global prefilterSaved
+    decision = {} if decision is None else decision
+
+    with span("preprocess"):
+        if settings.localPrefilter and isTriviallyClean(messageContent, settings.enforcementLevel):
+            decision["source"] = "prefilter"
+            prefilterSaved += 1
+            metrics["prefilter"].inc(result="skipped")
+            log.info(f"Pre-filter: clean, skipped API ({prefilterSaved} calls saved)")
+            return CLEAN_VERDICT
+
+        # Cache hits skip both the API round trip and the rate limiter
+        cacheKey = verdictCache.makeKey(messageContent)
+        cached = verdictCache.get(cacheKey)
+        metrics["cache"].inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            decision["source"] = "cache"
+            log.info(f"Verdict cache hit ({verdictCache.hits} hits / {verdictCache.misses} misses)")
+            return cached
+
+        if settings.localPrefilter:
+            metrics["prefilter"].inc(result="escalated")
+
+        # Typo fixes and one-word changes of a recent clean message get its verdict, except for an audit sample
+        # that's checked for real so we know how often reuse would have been wrong
+        auditing = None
+        if settings.nearDuplicateReuse:
+            similar = nearDuplicates.lookup(messageContent)
+            if similar is None:
+                metrics["nearDuplicate"].inc(result="miss")
+            elif random.random() >= settings.nearDuplicateAudit:
+                decision["source"] = "near_duplicate"
+                metrics["nearDuplicate"].inc(result="hit")
+                log.info(f"Near-duplicate of a recent clean message ({similar[1]:.0%} similar), reusing its verdict")
+                return similar[0]
+            else:
+                auditing = similar
+                metrics["nearDuplicate"].inc(result="audited")
+
+    chain = getClassifierChain()
+    if not chain:
+        decision["source"] = "no_backend"
+        return CLEAN_VERDICT
+
+    for i, backend in enumerate(chain):
+        decision["source"] = backend.name
+        verdict = await backend.classify(messageContent, i == len(chain) - 1, onEarlyDelete, decision)
+        if verdict is None:
+            continue
+        if auditing is not None and verdict.violates:
+            metrics["nearDuplicate"].inc(result="false_reuse")
+            log.warning(f"Near-duplicate reuse would have missed a violation ({auditing[1]:.0%} similar), consider a higher nearDuplicateThreshold")
+        if backend.cacheable:
+            verdictCache.put(cacheKey, verdict)
+            if not verdict.violates and settings.nearDuplicateReuse:
+                nearDuplicates.add(messageContent, verdict)
+        return verdict
+
+    # Every backend passed or failed
+    decision["source"] = "failed"
+    return CLEAN_VERDICT
+
+def phrasePattern(phrase):
+    # Tolerate the model collapsing or adding whitespace inside the phrase
+    return r"\s+".join(re.escape(token) for token in phrase.split())
+
+@functools.lru_cache(maxsize=512)
+def compileViolationMatcher(phrase):
+    # Inside a lookahead so every occurrence is found, even ones that overlap each other
+    return re.compile(f"(?=({phrasePattern(phrase)}))", re.IGNORECASE)
+
+def replaceViolations(content, violations):
+    phrases = []
+    replacements = []
+    spans = []  # (start, end, replacement)
+    seen = {}
+    for violation in violations:
+        # Determine final replacement
+        final_replacement = settings.customReplacement # Default to static setting
+
+        # If user has a custom prompt instruction, trust the model's output
+        replacement = violation.replacement
+        if settings.customPromptInstruction and replacement:
+            final_replacement = replacement
+
+        # Offsets are only trusted if they still point at the phrase (cached verdicts can come from a differently spaced message)
+        if violation.start is not None and content[violation.start:violation.end].casefold() == violation.phrase.casefold():
+            spans.append((violation.start, violation.end, final_replacement))
+            continue
+
+        phrase = violation.phrase.strip()
+        # Models like to end the phrase with the sentence's punctuation
+        phrase = phrase.rstrip('.,!?;:') or phrase
+        if not phrase or phrase.casefold() in seen:
+            continue
+        seen[phrase.casefold()] = len(phrases)
+        phrases.append(phrase)
+        replacements.append(final_replacement)
+
+    for phrase, replacement in zip(phrases, replacements):
+        found = False
+        for match in compileViolationMatcher(phrase).finditer(content):
+            spans.append((match.start(1), match.end(1), replacement))
+            found = True
+        if not found:
+            log.warning(f"Violation phrase not found in message: {phrase}")
+
+    if not spans:
+        return content
+
+    # Overlapping spans are merged into one covering all of them, so no part of any violation stays visible.
+    # The merged span gets the replacement of its widest member.
+    merged = []  # [start, end, replacement, width of the span the replacement came from]
+    for start, end, replacement in sorted(spans, key=lambda span: (span[0], -span[1])):
+        if merged and start < merged[-1][1]:
+            group = merged[-1]
+            group[1] = max(group[1], end)
+            if end - start > group[3]:
+                group[2], group[3] = replacement, end - start
+        else:
+            merged.append([start, end, replacement, end - start])
+
+    # Single pass over the original text, so a replacement is never matched again
+    pieces = []
+    last = 0
+    for start, end, replacement, _ in merged:
+        pieces.append(content[last:start])
+        pieces.append(replacement)
+        last = end
+    pieces.append(content[last:])
+
+    return "".join(pieces)
+
+botEdits = OrderedDict()  # message id -> content we edited it to, so on_message_edit can skip our own edits
+
+def rememberBotEdit(messageId, content):
+    botEdits[messageId] = content
+    while len(botEdits) > 500:
+        botEdits.popitem(last=False)
+
+async def moderateMessage(message, verdict, receivedAt=None, decision=None):
+    outcome = "unchanged"
     try:
-        if not analysis.get('violates_tos', False):
+        if not verdict.violates:
             return
         
-        action = analysis.get('action', 'edit')
-        violations = analysis.get('violations', [])
-        rewritten = analysis.get('rewritten_message')
+        action = verdict.action
+        violations = verdict.violations
+        rewritten = verdict.rewritten
         
         # Apply Moderation Mode Logic
-        if moderationMode == "Delete Only":
+        mode = settings.moderationMode
+        if mode == "Delete Only":
             action = "delete"
-        elif moderationMode == "Edit Only":
+        elif mode == "Edit Only":
             action = "edit"
         # "Hybrid" keeps the original action
         
         if action == 'delete':
             log.warning(f"Deleting message: {message.content}")
             await message.delete()
+            outcome = "deleted"
             
         elif action == 'edit':
             # Priority 1: Full rewrite from model (Best for custom prompts/Edit Only)
             if rewritten:
                 if rewritten != message.content:
                     log.warning(f"Rewriting to: {rewritten}")
+                    rememberBotEdit(message.id, rewritten)
                     await message.edit(content=rewritten)
+                    outcome = "edited"
                 return
 
             # Priority 2: Violation replacements (Best for partial/standard mode)
             if violations:
-                editedContent = message.content
-                
-                # optimization: sort by length so we dont replace substrings incorrectly
-                violations.sort(key=lambda v: len(v.get('phrase', '')), reverse=True)
-                
-                for violation in violations:
-                    phrase = violation.get('phrase', '')
-                    replacement = violation.get('replacement')
-                    
-                    # Determine final replacement
-                    final_replacement = customReplacement # Default to static setting
-                    
-                    # If user has a custom prompt instruction, trust the model's output
-                    if customPromptInstruction and replacement:
-                        final_replacement = replacement
-                    
-                    if phrase:
-                        editedContent = re.sub(re.escape(phrase), final_replacement, editedContent, flags=re.IGNORECASE)
+                editedContent = replaceViolations(message.content, violations)
                 
                 if editedContent != message.content:
                     log.warning(f"Editing to: {editedContent}")
+                    rememberBotEdit(message.id, editedContent)
                     await message.edit(content=editedContent)
+                    outcome = "edited"
             
     except discord.errors.NotFound:
+        outcome = "not_found"
         log.error("Message gone before we could edit it")
     except discord.errors.Forbidden:
+        outcome = "forbidden"
         log.error("Missing permissions to edit/delete")
     except Exception as e:
+        outcome = "error"
         log.error(f"Moderation failed: {e}")
+    finally:
+        if decision is not None:
+            decision["outcome"] = outcome
+        if verdict.violates:
+            metrics["moderation"].inc(outcome=outcome)
+            if receivedAt is not None and outcome in ("deleted", "edited"):
+                metrics["timeToAction"].observe(time.monotonic() - receivedAt)
 
 @client.event
 async def on_ready():
     log.info(f'Logged in as {client.user} ({client.user.id})')
     log.info('Moderation active.')
+    recordStartup()
+    loopMonitor.start()
+    await startMetricsServer()
+    if keyPool is not None:
+        asyncio.ensure_future(keyPool.warmUp())
+    scheduleCatchUp("ready")
     
     # Rich Presence Setup
     try:
@@ -398,63 +2334,371 @@ async def on_ready():
         except:
             pass
 
+def writeAudit(message, verdict, decision, receivedAt, startedAt, verdictAt):
+    # Compact record for offline analysis: no message text, just a hash to group repeats
+    now = time.monotonic()
+    verdict = verdict or CLEAN_VERDICT
+    snapshot = settings
+    record = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "message": message.id,
+        "channel": getattr(getattr(message, "channel", None), "id", None),
+        "chars": len(message.content or ""),
+        "hash": hashlib.sha256(normalizeMessage(message.content or "").encode()).hexdigest()[:16],
+        "source": decision.get("source"),
+        "violates": verdict.violates,
+        "action": verdict.action,
+        "severity": verdict.severity,
+        "violations": len(verdict.violations),
+        "outcome": decision["outcome"],
+        "level": snapshot.enforcementLevel,
+        "mode": snapshot.moderationMode,
+        "queueMs": round((startedAt - receivedAt) * 1000, 1),
+        "verdictMs": round((verdictAt - receivedAt) * 1000, 1) if verdictAt is not None else None,
+        "totalMs": round((now - receivedAt) * 1000, 1),
+        "stagesMs": {stage: round(seconds * 1000, 1) for stage, seconds in decision.get("stages", {}).items()},
+    }
+    audit.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+
+async def processMessage(message, receivedAt):
+    log.debug(f"Checking: {message.content}")
+    startedAt = time.monotonic()
+    verdictAt = None
+    verdict = None
+    decision = {"source": None, "outcome": "clean", "stages": {}}
+    currentTrace.set(decision["stages"])
+    recordSpan("queue", startedAt - receivedAt)
+
+    earlyDelete = []
+    def onEarlyDelete():
+        # Delete as soon as the streamed verdict says so, the rest of the response can wait
+        if not earlyDelete:
+            earlyDelete.append(asyncio.ensure_future(moderateMessage(message, Verdict(True, "delete"), receivedAt, decision)))
+
+    try:
+        verdict = await checkMessageWithGemini(message.content, onEarlyDelete, decision)
+        verdictAt = time.monotonic()
+        metrics["timeToVerdict"].observe(verdictAt - receivedAt)
+
+        if earlyDelete or verdict.violates:
+            with span("moderate"):
+                await (earlyDelete[0] if earlyDelete else moderateMessage(message, verdict, receivedAt, decision))
+    except asyncio.CancelledError:
+        decision["outcome"] = "cancelled"
+        raise
+    finally:
+        writeAudit(message, verdict, decision, receivedAt, startedAt, verdictAt)
+
+class AnalysisJob:
+    def __init__(self, message, background=False):
+        self.message = message
+        self.background = background
+        self.receivedAt = time.monotonic()
+        self.cancelled = False
+        self.task = None
+
+class AnalysisQueue:
+    def __init__(self):
+        self.queue = None  # Created lazily on the bot's event loop
+        self.workers = []
+        self.jobs = {}  # message id -> latest job for it
+        self.sequence = 0  # Keeps jobs of the same priority in arrival order
+        self.backgroundQueued = 0
+
+    def ensureWorkers(self):
+        if self.queue is None:
+            # Live messages always go before catch-up (background) ones
+            self.queue = asyncio.PriorityQueue(maxsize=settings.analysisQueueSize)
+            # A few more workers than API slots so cache hits don't sit behind rate-limited requests
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(settings.maxConcurrentRequests * 2)]
+
+    async def submit(self, message, background=False):
+        self.ensureWorkers()
+        self.cancel(message.id)
+        job = AnalysisJob(message, background)
+        self.jobs[message.id] = job
+        checkpoints.begin(message)
+
+        if self.queue.full() and not background:
+            log.warning(f"Analysis queue full ({settings.analysisQueueSize} messages), waiting for space")
+        self.sequence += 1
+        self.backgroundQueued += background
+        await self.queue.put((background, self.sequence, job))
+        metrics["queueDepth"].set(self.queue.qsize())
+
+    def cancel(self, messageId):
+        # Drop queued or in-flight work for a message that was edited or deleted
+        job = self.jobs.pop(messageId, None)
+        if job is None:
+            return
+        job.cancelled = True
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+            metrics["cancelled"].inc(stage="in_flight")
+        elif job.task is None:
+            metrics["cancelled"].inc(stage="queued")
+
+    async def worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            self.backgroundQueued -= job.background
+            metrics["queueDepth"].set(self.queue.qsize())
+            try:
+                if job.cancelled:
+                    continue
+                job.task = asyncio.ensure_future(processMessage(job.message, job.receivedAt))
+                try:
+                    await job.task
+                except asyncio.CancelledError:
+                    if not job.cancelled:
+                        raise
+                    log.info("Dropped analysis for a message that was edited or deleted")
+            except Exception as e:
+                log.error(f"Analysis failed: {e}")
+            finally:
+                if self.jobs.get(job.message.id) is job:
+                    del self.jobs[job.message.id]
+                checkpoints.finish(job.message)
+                self.queue.task_done()
+
+analysisQueue = AnalysisQueue()
+
+class ChannelCheckpoints:
+    # Last message id per channel that everything up to has been checked, in checkpoints.json
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = {}  # channel id -> message id, only ever moves forward
+        self.done = {}  # channel id -> newest message id finished since start
+        self.pending = {}  # channel id -> {message id: jobs in flight}
+        self.scanning = {}  # channel id -> newest message id a running catch-up scan has reached
+        self.saveTimer = None
+        try:
+            with open(path, 'r') as f:
+                self.saved = {int(channelId): int(messageId) for channelId, messageId in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error(f"Failed to load checkpoints: {e}")
+
+    def get(self, channelId):
+        return self.saved.get(channelId)
+
+    def queued(self, message):
+        return message.id in self.pending.get(message.channel.id, ())
+
+    def begin(self, message):
+        pending = self.pending.setdefault(message.channel.id, {})
+        pending[message.id] = pending.get(message.id, 0) + 1
+
+    def finish(self, message):
+        channelId = message.channel.id
+        pending = self.pending.get(channelId, {})
+        if pending.get(message.id, 0) > 1:
+            pending[message.id] -= 1
+        else:
+            pending.pop(message.id, None)
+        self.done[channelId] = max(self.done.get(channelId, 0), message.id)
+
+        # Never move past a message that's still queued or not scanned yet, a crash now would skip it on the next scan
+        checkpoint = self.done[channelId]
+        if pending:
+            checkpoint = min(checkpoint, min(pending) - 1)
+        if channelId in self.scanning:
+            checkpoint = min(checkpoint, self.scanning[channelId])
+        if checkpoint > self.saved.get(channelId, 0):
+            with self.lock:
+                self.saved[channelId] = checkpoint
+            self.save()
+
+    def forget(self, channelId):
+        self.scanning.pop(channelId, None)
+        with self.lock:
+            self.saved.pop(channelId, None)
+        self.save()
+
+    def save(self):
+        # Debounced like config.json, a busy channel would otherwise write on every message
+        with self.lock:
+            if self.saveTimer is None:
+                self.saveTimer = threading.Timer(CHECKPOINT_SAVE_DELAY, self.write)
+                self.saveTimer.daemon = True
+                self.saveTimer.start()
+
+    def flush(self):
+        with self.lock:
+            pending = self.saveTimer
+        if pending is not None:
+            pending.cancel()
+            self.write()
+
+    def write(self):
+        with self.lock:
+            self.saveTimer = None
+            data = {str(channelId): messageId for channelId, messageId in self.saved.items()}
+        tmpFile = self.path + '.tmp'
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpFile, self.path)
+        except Exception as e:
+            log.error(f"Failed to save checkpoints: {e}")
+
+CHECKPOINT_SAVE_DELAY = 2.0  # Seconds between checkpoints.json writes, at worst this much gets checked twice after a crash
+CATCH_UP_PAGE = 100  # Messages per history request, Discord's maximum
+checkpoints = ChannelCheckpoints(CHECKPOINT_FILE)
+catchUpTask = None
+
+def scheduleCatchUp(reason):
+    # Safe to call from the tray and config threads
+    if not client.is_ready():
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        client.loop.call_soon_threadsafe(startCatchUp, reason)
+        return
+    startCatchUp(reason)
+
+def startCatchUp(reason):
+    global catchUpTask
+    if not settings.catchUpScan or not settings.isModerationActive:
+        return
+    if catchUpTask is not None and not catchUpTask.done():
+        return  # The running scan already covers everything up to now
+    catchUpTask = asyncio.ensure_future(catchUp(reason))
+
+async def resolveChannel(channelId):
+    channel = client.get_channel(channelId)
+    if channel is None:
+        try:
+            channel = await client.fetch_channel(channelId)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+    return channel
+
+async def catchUpChannel(channelId, oldest):
+    # Page through the channel's history since its checkpoint and queue our own messages at low priority
+    channel = await resolveChannel(channelId)
+    if channel is None:
+        log.info(f"Catch-up: channel {channelId} is gone, dropping its checkpoint")
+        checkpoints.forget(channelId)
+        return 0
+
+    after = max(checkpoints.get(channelId) or 0, oldest)
+    checkpoints.scanning[channelId] = after
+    found = 0
+    try:
+        async for message in channel.history(limit=None, after=discord.Object(id=after), oldest_first=True):
+            if not settings.isModerationActive:
+                break
+            if message.author.id == client.user.id and message.content and not checkpoints.queued(message):
+                # Only keep a few catch-up jobs queued, live messages jump ahead of them anyway
+                while analysisQueue.backgroundQueued >= settings.maxConcurrentRequests:
+                    await asyncio.sleep(0.1)
+                await analysisQueue.submit(message, background=True)
+                found += 1
+            checkpoints.scanning[channelId] = message.id
+    finally:
+        checkpoints.scanning.pop(channelId, None)
+    return found
+
+async def catchUp(reason):
+    # Messages sent while we were offline, reconnecting or disabled never reach on_message
+    channelIds = list(checkpoints.saved)
+    if not channelIds:
+        return
+    started = time.monotonic()
+    oldest = discord.utils.time_snowflake(datetime.now() - timedelta(seconds=settings.catchUpMaxAge))
+    limit = asyncio.Semaphore(settings.catchUpChannels)
+
+    async def scan(channelId):
+        async with limit:
+            try:
+                found = await catchUpChannel(channelId, oldest)
+            except discord.HTTPException as e:
+                log.warning(f"Catch-up: couldn't read channel {channelId}: {e}")
+                checkpoints.scanning.pop(channelId, None)
+                return 0
+            metrics["catchUp"].inc(result="channel")
+            metrics["catchUp"].inc(found, result="message")
+            return found
+
+    for channelId in channelIds:
+        # Hold every checkpoint where it is until its channel has been scanned
+        checkpoints.scanning[channelId] = checkpoints.get(channelId)
+    log.info(f"Catch-up scan ({reason}) of {len(channelIds)} channels")
+    found = sum(await asyncio.gather(*[scan(channelId) for channelId in channelIds]))
+    metrics["messages"].inc(found)
+    log.info(f"Catch-up scan found {found} unchecked messages in {time.monotonic() - started:.1f}s")
+
 @client.event
 async def on_message(message):
-    global isModerationActive
-    
-    if not isModerationActive:
+    if not settings.isModerationActive:
         return
 
     if message.author.id != client.user.id or not message.content:
         return
-    
-    log.info(f"Checking: {message.content}")
-    
-    analysis = await checkMessageWithGemini(message.content)
-    
-    if analysis.get('violates_tos', False):
-        await moderateMessage(message, analysis)
+
+    metrics["messages"].inc()
+    await analysisQueue.submit(message)
+
+@client.event
+async def on_message_edit(before, after):
+    if after.author.id != client.user.id or before.content == after.content:
+        return
+
+    # Our own moderation edits come back through here too
+    if botEdits.get(after.id) == after.content:
+        del botEdits[after.id]
+        return
+
+    analysisQueue.cancel(after.id)
+    if settings.isModerationActive and after.content:
+        metrics["messages"].inc()
+        await analysisQueue.submit(after)
+
+@client.event
+async def on_resumed():
+    scheduleCatchUp("resumed")
+
+@client.event
+async def on_message_delete(message):
+    if message.author.id == client.user.id:
+        analysisQueue.cancel(message.id)
 
 def createTrayIcon():
-    global trayIcon, isModerationActive, enforcementLevel, apiTier, moderationMode, customReplacement
+    global trayIcon
 
     def onClicked(icon, item):
-        global isModerationActive
         strItem = str(item)
         if strItem == "Enable Moderation":
-            isModerationActive = not isModerationActive
-            save_config()
-            state = "Enabled" if isModerationActive else "Disabled"
+            updateSettings(isModerationActive=not settings.isModerationActive)
+            state = "Enabled" if settings.isModerationActive else "Disabled"
             icon.notify(f"ToS Moderation: {state}", "Discord Bot")
             log.info(f"Toggled moderation: {state}")
+            if settings.isModerationActive:
+                scheduleCatchUp("re-enabled")
 
     def onLevelSelect(icon, item):
-        global enforcementLevel
-        enforcementLevel = str(item)
-        save_config()
-        icon.notify(f"Level: {enforcementLevel}", "Discord Bot")
-        log.info(f"Level set to: {enforcementLevel}")
+        updateSettings(enforcementLevel=str(item))
+        icon.notify(f"Level: {settings.enforcementLevel}", "Discord Bot")
+        log.info(f"Level set to: {settings.enforcementLevel}")
 
     def onTierSelect(icon, item):
-        global apiTier
-        apiTier = str(item)
-        save_config()
-        icon.notify(f"API Tier: {apiTier}", "Discord Bot")
-        log.info(f"API Tier set to: {apiTier}")
+        updateSettings(apiTier=str(item))
+        icon.notify(f"API Tier: {settings.apiTier}", "Discord Bot")
+        log.info(f"API Tier set to: {settings.apiTier}")
 
     def onModeSelect(icon, item):
-        global moderationMode
-        moderationMode = str(item)
-        save_config()
-        icon.notify(f"Mode: {moderationMode}", "Discord Bot")
-        log.info(f"Moderation Mode set to: {moderationMode}")
+        updateSettings(moderationMode=str(item))
+        icon.notify(f"Mode: {settings.moderationMode}", "Discord Bot")
+        log.info(f"Moderation Mode set to: {settings.moderationMode}")
 
     def onSetReplacement(icon, item):
-        global customReplacement
-        
         # Use PowerShell for a robust input dialog on Windows
         try:
-            safe_current = customReplacement.replace("'", "''")
+            safe_current = settings.customReplacement.replace("'", "''")
             ps_script = f"""
             Add-Type -AssemblyName Microsoft.VisualBasic
             $res = [Microsoft.VisualBasic.Interaction]::InputBox('Enter new replacement text:', 'Set Replacement Text', '{safe_current}')
@@ -465,20 +2709,17 @@ def createTrayIcon():
             new_text = result.strip()
             
             if new_text:
-                customReplacement = new_text
-                save_config()
-                icon.notify(f"Replacement set to: {customReplacement}", "Discord Bot")
-                log.info(f"Custom replacement set to: {customReplacement}")
+                updateSettings(customReplacement=new_text)
+                icon.notify(f"Replacement set to: {settings.customReplacement}", "Discord Bot")
+                log.info(f"Custom replacement set to: {settings.customReplacement}")
                 
         except Exception as e:
             log.error(f"Failed to open dialog: {e}")
             icon.notify("Error opening input dialog", "Discord Bot")
 
     def onSetCustomPrompt(icon, item):
-        global customPromptInstruction
-        
         try:
-            safe_current = customPromptInstruction.replace("'", "''")
+            safe_current = settings.customPromptInstruction.replace("'", "''")
             ps_script = f"""
             Add-Type -AssemblyName Microsoft.VisualBasic
             $res = [Microsoft.VisualBasic.Interaction]::InputBox('Enter custom prompt instruction (Leave empty for default):', 'Set Custom Prompt', '{safe_current}')
@@ -489,12 +2730,11 @@ def createTrayIcon():
             new_text = result.strip()
             
             # Allow clearing it
-            customPromptInstruction = new_text
-            save_config()
+            updateSettings(customPromptInstruction=new_text)
             
-            if customPromptInstruction:
+            if settings.customPromptInstruction:
                 icon.notify(f"Custom Prompt Active", "Discord Bot")
-                log.info(f"Custom prompt set to: {customPromptInstruction}")
+                log.info(f"Custom prompt set to: {settings.customPromptInstruction}")
             else:
                 icon.notify(f"Custom Prompt Disabled", "Discord Bot")
                 log.info(f"Custom prompt disabled")
@@ -503,7 +2743,14 @@ def createTrayIcon():
             log.error(f"Failed to open dialog: {e}")
             icon.notify("Error opening input dialog", "Discord Bot")
 
+    def onShowStats(icon, item):
+        icon.notify(metricsSummary(), "Discord Bot")
+
     def onExit(icon, item):
+        flushConfig()
+        checkpoints.flush()
+        loopMonitor.dumpProfile()
+        logListener.stop()
         icon.stop()
         os._exit(0)
 
@@ -516,32 +2763,183 @@ def createTrayIcon():
         pystray.MenuItem(
             "Enable Moderation", 
             onClicked, 
-            checked=lambda item: isModerationActive
+            checked=lambda item: settings.isModerationActive
         ),
         pystray.Menu.SEPARATOR,
         pystray.MenuItem("Enforcement Level", pystray.Menu(
-            pystray.MenuItem("Strict", onLevelSelect, checked=lambda item: enforcementLevel == "Strict"),
-            pystray.MenuItem("Standard", onLevelSelect, checked=lambda item: enforcementLevel == "Standard"),
-            pystray.MenuItem("Lenient", onLevelSelect, checked=lambda item: enforcementLevel == "Lenient")
+            pystray.MenuItem("Strict", onLevelSelect, checked=lambda item: settings.enforcementLevel == "Strict"),
+            pystray.MenuItem("Standard", onLevelSelect, checked=lambda item: settings.enforcementLevel == "Standard"),
+            pystray.MenuItem("Lenient", onLevelSelect, checked=lambda item: settings.enforcementLevel == "Lenient")
         )),
         pystray.MenuItem("API Tier", pystray.Menu(
-            pystray.MenuItem("Free", onTierSelect, checked=lambda item: apiTier == "Free"),
-            pystray.MenuItem("Tier 1", onTierSelect, checked=lambda item: apiTier == "Tier 1")
+            pystray.MenuItem("Free", onTierSelect, checked=lambda item: settings.apiTier == "Free"),
+            pystray.MenuItem("Tier 1", onTierSelect, checked=lambda item: settings.apiTier == "Tier 1")
         )),
         pystray.MenuItem("Moderation Mode", pystray.Menu(
-            pystray.MenuItem("Hybrid", onModeSelect, checked=lambda item: moderationMode == "Hybrid"),
-            pystray.MenuItem("Edit Only", onModeSelect, checked=lambda item: moderationMode == "Edit Only"),
-            pystray.MenuItem("Delete Only", onModeSelect, checked=lambda item: moderationMode == "Delete Only")
+            pystray.MenuItem("Hybrid", onModeSelect, checked=lambda item: settings.moderationMode == "Hybrid"),
+            pystray.MenuItem("Edit Only", onModeSelect, checked=lambda item: settings.moderationMode == "Edit Only"),
+            pystray.MenuItem("Delete Only", onModeSelect, checked=lambda item: settings.moderationMode == "Delete Only")
         )),
         pystray.MenuItem("Set Replacement Text", onSetReplacement),
         pystray.MenuItem("Set Custom Prompt", onSetCustomPrompt),
         pystray.Menu.SEPARATOR,
+        pystray.MenuItem("Show Stats", onShowStats),
+        pystray.Menu.SEPARATOR,
         pystray.MenuItem("Exit", onExit)
     )
 
     trayIcon = pystray.Icon("Discord ToS Bot", image, "Discord ToS Moderator", menu)
     trayIcon.run()
 
+# Replay mode: classify an exported message history offline with the live pipeline, e.g.
+#   python main.py --replay history.jsonl --out strict.jsonl --level Strict
+REPLAY_PROGRESS_INTERVAL = 10.0  # Seconds between progress lines
+
+def parseReplayArgs():
+    parser = argparse.ArgumentParser(description="Classify a JSONL/CSV export of messages without connecting to Discord")
+    parser.add_argument("--replay", required=True, metavar="FILE", help="JSONL (one object per line) or CSV with a 'content' column, optional 'id'")
+    parser.add_argument("--out", help="verdicts are appended here as JSONL, also the checkpoint to resume from (default: <FILE>.verdicts.jsonl)")
+    parser.add_argument("--level", choices=["Strict", "Standard", "Lenient"], help="enforcementLevel to use instead of config.json")
+    parser.add_argument("--mode", choices=["Hybrid", "Edit Only", "Delete Only"], help="moderationMode to use instead of config.json")
+    parser.add_argument("--prompt", help="customPromptInstruction to use instead of config.json ('' to clear it)")
+    parser.add_argument("--concurrency", type=int, help="maxConcurrentRequests to use instead of config.json")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the verdict cache")
+    parser.add_argument("--verbose", action="store_true", help="keep per-message log output")
+    return parser.parse_args()
+
+def readReplayMessages(path):
+    # [(id, content)], ids default to the line/row number
+    messages = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            for i, row in enumerate(csv.DictReader(f), 1):
+                content = row.get('content') or row.get('text') or row.get('message') or next(iter(row.values()), '')
+                messages.append((row.get('id') or str(i), content or ''))
+        else:
+            for i, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    messages.append((str(i), record))
+                else:
+                    messages.append((str(record.get('id', i)), record.get('content') or record.get('text') or record.get('message') or ''))
+    return messages
+
+def readCheckpoint(path):
+    # Every line in the output is a finished message, so the output doubles as the checkpoint
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)['id']))
+            except (ValueError, KeyError):
+                pass  # a line cut short by a crash
+    return done
+
+async def replayMessages(messages, out):
+    loopMonitor.start()
+    pending = deque(messages)
+    timings = []
+    sources = {}
+    flagged = 0
+    failed = 0
+    started = time.monotonic()
+    lastReport = started
+
+    async def worker():
+        nonlocal flagged, failed, lastReport
+        while pending:
+            messageId, content = pending.popleft()
+            decision = {}
+            messageStarted = time.monotonic()
+            verdict = await checkMessageWithGemini(content, None, decision)
+            elapsed = time.monotonic() - messageStarted
+
+            source = decision.get("source", "none")
+            sources[source] = sources.get(source, 0) + 1
+            if source in ("failed", "no_backend"):
+                # Not classified, so not written: the output is the checkpoint and a rerun should try again
+                failed += 1
+                continue
+            timings.append(elapsed)
+            flagged += verdict.violates
+            out.write(json.dumps({"id": messageId, "source": source, "ms": round(elapsed * 1000, 1), "verdict": verdict.toDict()}, ensure_ascii=False) + "\n")
+            out.flush()
+
+            now = time.monotonic()
+            if now - lastReport >= REPLAY_PROGRESS_INTERVAL:
+                lastReport = now
+                rate = (len(timings) + failed) / (now - started)
+                print(f"{len(timings) + failed}/{len(messages)} messages, {rate:.1f} msg/s, ETA {len(pending) / rate if rate else 0:.0f}s", flush=True)
+
+    # Enough workers to keep every key and request slot busy, the key pool and semaphore do the limiting
+    workers = max(1, settings.maxConcurrentRequests * 2, len(apiKeys) * 2)
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    return timings, sources, flagged, failed, time.monotonic() - started
+
+def runReplay():
+    global settings, verdictCache
+    args = parseReplayArgs()
+    if not args.verbose:
+        log.setLevel(logging.WARNING)
+
+    # Overrides only apply to this run, config.json is left alone
+    overrides = {}
+    if args.level:
+        overrides["enforcementLevel"] = args.level
+    if args.mode:
+        overrides["moderationMode"] = args.mode
+    if args.prompt is not None:
+        overrides["customPromptInstruction"] = args.prompt
+    if args.concurrency:
+        overrides["maxConcurrentRequests"] = max(1, args.concurrency)
+    if args.no_cache:
+        overrides["nearDuplicateReuse"] = False
+    settings = dataclasses.replace(settings, **overrides)
+    if args.no_cache:
+        verdictCache = VerdictCache(0, 0)
+    verdictCache.open()
+    if not getClassifierChain():
+        print("No classifier backend available: set GEMINI_API_KEY(S) in .env or configure classifierBackends", file=sys.stderr)
+        sys.exit(1)
+
+    outPath = args.out or f"{args.replay}.verdicts.jsonl"
+    messages = readReplayMessages(args.replay)
+    done = readCheckpoint(outPath)
+    remaining = [(messageId, content) for messageId, content in messages if messageId not in done]
+    print(f"Replaying {len(remaining)} of {len(messages)} messages ({len(messages) - len(remaining)} already in {outPath}) "
+          f"at {settings.enforcementLevel} / {settings.moderationMode}" + (" with custom prompt" if settings.customPromptInstruction else ""), flush=True)
+    if not remaining:
+        return
+
+    callsBefore = sum(e[-1] for e in metrics["apiLatency"].values.values())
+    with open(outPath, 'a', encoding='utf-8') as out:
+        timings, sources, flagged, failed, elapsed = asyncio.run(replayMessages(remaining, out))
+    loopMonitor.dumpProfile()
+
+    timings.sort()
+    calls = sum(e[-1] for e in metrics["apiLatency"].values.values()) - callsBefore
+    print(f"Done: {len(timings)} messages in {elapsed:.1f}s, {len(timings) / elapsed:.1f} msg/s")
+    if failed:
+        print(f"Failed {failed} (every backend failed, not written, run again to retry them)")
+    if timings:
+        print(f"Flagged {flagged} ({flagged / len(timings) * 100:.1f}%), Gemini calls {calls}, "
+              f"p50 {timings[len(timings) // 2] * 1000:.0f}ms, p95 {timings[int(len(timings) * 0.95)] * 1000:.0f}ms")
+    print("Sources: " + ", ".join(f"{source} {count}" for source, count in sorted(sources.items(), key=lambda item: -item[1])))
+
+def runSelfCheck():
+    # Quick regression checks for the pure helpers that decide when the model is skipped
+    failures = [f"near-duplicate: {stored!r} -> {new!r}" for stored, new in checkNearDuplicates()]
+    failures += [f"pre-filter: {message!r} at {level}" for message, level in checkPrefilter()]
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"Self-check: {len(failures)} failures")
+    return 1 if failures else 0
+
 def runBot(token):
     try:
         client.run(token)
@@ -552,19 +2950,41 @@ def runBot(token):
 
 def main():
     global rpcProcess
+    importTime = time.monotonic() - processStarted
+    if "--startup-check" in sys.argv:
+        print(f"Import time {importTime:.3f}s (budget {STARTUP_BUDGET:.1f}s)")
+        sys.exit(0 if importTime <= STARTUP_BUDGET else 1)
+    if "--self-check" in sys.argv:
+        sys.exit(runSelfCheck())
+    if importTime > STARTUP_BUDGET:
+        log.warning(f"Imports took {importTime:.2f}s, over the {STARTUP_BUDGET:.1f}s startup budget")
+
+    if "--replay" in sys.argv:
+        runReplay()
+        return
+
     token = os.getenv('DISCORD_TOKEN')
-    apiKey = os.getenv('GEMINI_API_KEY')
     
-    if not token or not apiKey:
-        log.error("Missing DISCORD_TOKEN or GEMINI_API_KEY in .env")
+    if not token:
+        log.error("Missing DISCORD_TOKEN in .env")
+        return
+    if not apiKeys and all(name == "gemini" for name in settings.classifierBackends):
+        log.error("Missing GEMINI_API_KEY(S) in .env, and no other classifier backend is configured")
         return
     
-    log.info("Starting up...")
+    log.info(f"Starting up... (imports took {importTime:.2f}s)")
+    verdictCache.open()
+    threading.Thread(target=watchConfig, daemon=True).start()
+    if apiKeys:
+        # Import the Gemini SDK while the gateway logs in instead of on the first message
+        threading.Thread(target=loadGenai, daemon=True).start()
+    if "local" in settings.classifierBackends:
+        threading.Thread(target=loadOnnx, daemon=True).start()
     
     botThread = threading.Thread(target=runBot, args=(token,), daemon=True)
     botThread.start()
 
-    if "--headless" in sys.argv or pystray is None:
+    if "--headless" in sys.argv or not loadTray():
         log.info("Running in headless mode (No Tray Icon)")
         # In headless mode, we need to keep the main thread alive.
         # Since runBot is already in a thread, we can just join it or loop.
@@ -574,6 +2994,10 @@ def main():
             botThread.join()
         except KeyboardInterrupt:
             log.info("Stopping...")
+            flushConfig()
+            checkpoints.flush()
+            loopMonitor.dumpProfile()
+            logListener.stop()
             os._exit(0)
     else:
         createTrayIcon()